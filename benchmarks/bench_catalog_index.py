@@ -0,0 +1,73 @@
+"""Micro-benchmark: nested price scans vs. CatalogIndex lookups.
+
+Run from the repository root:
+
+    python benchmarks/bench_catalog_index.py
+
+For each catalog size it times the old per-request work of the farmer
+dashboard (a list comprehension over every price for every product, then a
+sort) against building a CatalogIndex once and answering the same query
+with a lookup.
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import CatalogIndex  # noqa: E402
+
+CATEGORIES = ('Bulmet', 'Shtazore', 'Fruta', 'Perime', 'Pije', 'Tjera')
+
+
+def synthetic_catalog(size, prices_per_product=2, farmers=50):
+    rng = random.Random(size)
+    products, prices = [], []
+    for i in range(size):
+        products.append({
+            'id': f'prod_{i}',
+            'name': f'Produkt {i}',
+            'description': '',
+            'images': [],
+            'active': True,
+            'metadata': {'Category': rng.choice(CATEGORIES), 'Fermeri': f'Fermer {i % farmers}'},
+        })
+        for j in range(prices_per_product):
+            prices.append({
+                'id': f'price_{i}_{j}',
+                'product': f'prod_{i}',
+                'unit_amount': rng.randint(100, 100000),
+                'created': j,
+                'active': True,
+            })
+    rng.shuffle(prices)
+    return products, prices
+
+
+def nested_scan(products, prices, farmer):
+    result = []
+    for product in products:
+        product_prices = [p for p in prices if p['product'] == product['id']]
+        if not product_prices:
+            continue
+        latest_price = sorted(product_prices, key=lambda p: p['created'], reverse=True)[0]
+        if product['metadata'].get('Fermeri', '') == farmer:
+            result.append((product['id'], latest_price['id']))
+    return result
+
+
+def main():
+    print(f"{'products':>9} {'nested scan':>14} {'index build':>14} {'index lookup':>14}")
+    for size in (100, 500, 1000, 2000, 5000):
+        products, prices = synthetic_catalog(size)
+        runs = 1 if size >= 2000 else 3
+        scan = min(timeit.repeat(lambda: nested_scan(products, prices, 'Fermer 7'), number=1, repeat=runs))
+        build = min(timeit.repeat(lambda: CatalogIndex.from_stripe(products, prices), number=1, repeat=5))
+        index = CatalogIndex.from_stripe(products, prices)
+        lookup = min(timeit.repeat(lambda: index.farmer('Fermer 7'), number=1000, repeat=5)) / 1000
+        print(f"{size:>9} {scan * 1e3:>12.2f}ms {build * 1e3:>12.2f}ms {lookup * 1e6:>12.2f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Load test: concurrent user reads and registrations on SQLite, rollback journal vs. WAL.
+
+Run from the repository root:
+
+    python benchmarks/bench_db_concurrency.py [seconds] [readers] [writers]
+
+Each mode gets a fresh database file holding the ``Perdoruesit`` table.
+Reader threads look users up by email (as the login view does) and read
+pages of the admin user list. Writer threads insert new users (as
+registration does). Both run for the given number of seconds. The
+"journal" mode is SQLite's default. The "wal" mode is what the app
+configures through database.py.
+"""
+import itertools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.exc import OperationalError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DB_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import main  # noqa: E402
+from database import engine_options, tune_sqlite  # noqa: E402
+
+USERS = main.Perdoruesit.__table__
+SEED_USERS = 2000
+
+
+def make_engine(path, wal):
+    uri = f'sqlite:///{path}'
+    if wal:
+        engine = create_engine(uri, **engine_options(uri, pool_size=16, max_overflow=16))
+        tune_sqlite(engine)
+    else:
+        # SQLite's defaults: rollback journal, 5s lock timeout from the sqlite3 module
+        engine = create_engine(uri, pool_size=16, max_overflow=16)
+    USERS.metadata.create_all(engine, tables=[USERS])
+    for index in USERS.indexes:
+        index.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(insert(USERS), [
+            {'name': f'user{i}', 'email': f'user{i}@example.com', 'password': 'x',
+             'role': 'Fermer' if i % 3 else 'Konsumator'}
+            for i in range(SEED_USERS)
+        ])
+    return engine
+
+
+def run_mode(wal, seconds, readers, writers):
+    path = os.path.join(tempfile.mkdtemp(), 'load.db')
+    engine = make_engine(path, wal)
+    deadline = time.perf_counter() + seconds
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    latencies = []
+    lock = threading.Lock()
+    names = itertools.count(SEED_USERS)
+
+    def reader(seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                email = f'user{rng.randrange(SEED_USERS)}@example.com'
+                with engine.connect() as connection:
+                    connection.execute(select(USERS).where(USERS.c.email == email)).first()
+                    connection.execute(select(USERS).where(USERS.c.id > rng.randrange(SEED_USERS))
+                                       .order_by(USERS.c.id).limit(50)).all()
+                outcome = 'reads'
+            except OperationalError:
+                outcome = 'errors'
+            with lock:
+                counts[outcome] += 1
+                latencies.append(time.perf_counter() - start)
+
+    def writer():
+        while time.perf_counter() < deadline:
+            i = next(names)
+            try:
+                with engine.begin() as connection:
+                    connection.execute(insert(USERS).values(name=f'user{i}', email=f'user{i}@example.com',
+                                                            password='x', role='Konsumator'))
+                outcome = 'writes'
+            except OperationalError:
+                outcome = 'errors'
+            with lock:
+                counts[outcome] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+    return counts, p99
+
+
+def run():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    print(f"{readers} readers, {writers} writers, {seconds:g}s per mode")
+    print(f"{'mode':>8} {'reads/s':>10} {'writes/s':>10} {'errors':>8} {'read p99':>10}")
+    for name, wal in (('journal', False), ('wal', True)):
+        counts, p99 = run_mode(wal, seconds, readers, writers)
+        print(f"{name:>8} {counts['reads'] / seconds:>10.0f} {counts['writes'] / seconds:>10.0f} "
+              f"{counts['errors']:>8} {p99 * 1e3:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    run()
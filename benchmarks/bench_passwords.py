@@ -0,0 +1,112 @@
+"""Benchmark: login throughput and catalog latency, hashing inline vs. on the process pool.
+
+Run from the repository root:
+
+    python benchmarks/bench_passwords.py [seconds] [login threads] [catalog threads]
+
+Login threads post to /login as fast as they can while catalog threads
+request /api/products (served from the warm in-memory catalog). Each
+configuration reports logins per second and the p50/p95 latency of the
+catalog requests. The first row is the catalog alone, as a baseline. The
+"inline" row hashes on the request threads (PASSWORD_HASH_WORKERS=0), the
+"pool" row on the worker processes.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DB_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import main  # noqa: E402
+from passwords import PasswordHasher  # noqa: E402
+
+USERS = 50
+PASSWORD = 'fjalekalim123'
+
+
+def populate():
+    main.db.session.add_all(
+        main.Product(id=f'prod_{i}', name=f'Produkt {i}', description='', image=None, category='Fruta',
+                     farmer='Fermer', active=True, created=i)
+        for i in range(500)
+    )
+    main.db.session.add_all(
+        main.Price(id=f'price_{i}', product_id=f'prod_{i}', unit_amount=100 + i, currency='all', active=True,
+                   created=i)
+        for i in range(500)
+    )
+    stored = main.password_hasher.hash(PASSWORD)
+    main.db.session.add_all(
+        main.Perdoruesit(name=f'user{i}', email=f'user{i}@example.com', password=stored, role='Konsumator')
+        for i in range(USERS)
+    )
+    main.db.session.commit()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def load(seconds, login_threads, catalog_threads):
+    deadline = time.perf_counter() + seconds
+    logins = []
+    latencies = []
+    lock = threading.Lock()
+
+    def login(n):
+        client = main.app.test_client()
+        i = n
+        while time.perf_counter() < deadline:
+            response = client.post('/login', data={'email': f'user{i % USERS}@example.com', 'password': PASSWORD})
+            with lock:
+                logins.append(response.location == '/home')
+            client.get('/logout')
+            i += login_threads
+
+    def catalog():
+        client = main.app.test_client()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            client.get('/api/products?category=Fruta&limit=24').get_data()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=login, args=(n,)) for n in range(login_threads)]
+    threads += [threading.Thread(target=catalog) for _ in range(catalog_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(logins), "a login failed"
+    return len(logins) / seconds, percentile(latencies, 0.5), percentile(latencies, 0.95)
+
+
+def run():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    login_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    catalog_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    main.app.config['WTF_CSRF_ENABLED'] = False
+    main.app.config['STRIPE_WEBHOOK_SECRET'] = 'whsec_bench'
+    with main.app.app_context():
+        populate()
+    main.get_catalog()
+
+    pool = main.password_hasher
+    inline = PasswordHasher(method=pool.method, salt_length=pool.salt_length, workers=0)
+    print(f"{login_threads} login threads, {catalog_threads} catalog threads, {seconds:g}s each, "
+          f"{pool.method}, {pool.workers} hashing processes")
+    print(f"{'':>10} {'logins/s':>10} {'catalog p50':>12} {'catalog p95':>12}")
+    runs = (('catalog', pool, 0), ('inline', inline, login_threads), ('pool', pool, login_threads))
+    for name, hasher, threads in runs:
+        main.password_hasher = hasher
+        rate, p50, p95 = load(seconds, threads, catalog_threads)
+        print(f"{name:>10} {rate:>10.1f} {p50 * 1e3:>10.1f}ms {p95 * 1e3:>10.1f}ms")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,70 @@
+"""Benchmark: serving the catalog from the local replica vs. listing it from Stripe.
+
+Run from the repository root:
+
+    python benchmarks/bench_replica.py [products]
+
+A synthetic catalog is written to a throwaway SQLite database and the time to
+build the catalog index and to run an indexed category query is measured.
+When a Stripe key is configured (the same ``SECRET KEY`` variable main.py
+reads), a full paginated listing of the real account is timed as well.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DB_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import main  # noqa: E402
+from catalog import iter_prices, iter_products  # noqa: E402
+
+CATEGORIES = ('Bulmet', 'Shtazore', 'Fruta', 'Perime', 'Pije', 'Tjera')
+
+
+def timed(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def populate(size):
+    rng = random.Random(size)
+    main.db.session.add_all(
+        main.Product(id=f'prod_{i}', name=f'Produkt {i}', description='', image=None,
+                     category=rng.choice(CATEGORIES), farmer=f'Fermer {i % 50}', active=True, created=i)
+        for i in range(size)
+    )
+    main.db.session.add_all(
+        main.Price(id=f'price_{i}', product_id=f'prod_{i}', unit_amount=rng.randint(100, 100000),
+                   currency='all', active=True, created=i)
+        for i in range(size)
+    )
+    main.db.session.commit()
+
+
+def run():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with main.app.app_context():
+        populate(size)
+        build = timed(main.replica.load_index)
+        query = timed(lambda: main.db.session.execute(
+            main.db.select(main.Product).where(main.Product.active.is_(True), main.Product.category == 'Fruta')
+        ).scalars().all())
+        print(f"replica, {size} products: index build {build * 1e3:.1f}ms, category query {query * 1e3:.2f}ms")
+
+    if main.stripe.api_key:
+        listing = timed(lambda: (list(iter_products()), list(iter_prices())), repeat=1)
+        print(f"stripe: full paginated listing {listing * 1e3:.1f}ms")
+    else:
+        print("stripe: skipped (no API key in 'SECRET KEY')")
+
+
+if __name__ == '__main__':
+    run()
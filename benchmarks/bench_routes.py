@@ -0,0 +1,387 @@
+"""Benchmark: latency, throughput and Stripe calls of the app's routes, fully offline.
+
+Run from the repository root:
+
+    python benchmarks/bench_routes.py [--products 5000] [--concurrency 1,8,32] [--seconds 5]
+        [--routes fruta,kerko,...] [--latency 0.05] [--error-rate 0]
+        [--output results.json] [--baseline old-results.json] [--tolerance 0.1]
+
+Nothing leaves the machine:
+
+- fake_stripe.py serves a synthetic catalog (synthetic_catalog.py) of
+  ``--products`` products. It answers after ``--latency`` seconds and fails
+  a fraction ``--error-rate`` of calls.
+- fake_smtp.py receives the farmers' order emails.
+- The app runs under ``flask run``, in its own process, on a throwaway
+  SQLite database. The database holds an account for each farmer the
+  virtual users log in as.
+
+For each route and concurrency level the script keeps that many requests in
+flight for ``--seconds``. Each virtual user has its own cookies, and is
+logged in or has a filled cart where the route needs it. Each row reports:
+
+- throughput and p50/p95/p99 latency;
+- errors: status 400 or above, or no response;
+- Stripe calls per request, counted by the fake Stripe, so background
+  catalog refreshes are included;
+- server CPU time per request.
+
+``--output`` writes the rows and the settings as JSON. ``--baseline``
+compares with such a file from an earlier run, and exits with status 1 when
+a route's p95 latency or throughput got worse by more than ``--tolerance``.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import hashlib
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer
+from werkzeug.security import generate_password_hash
+
+from fake_smtp import FakeSMTP
+from synthetic_catalog import CATEGORIES, WORDS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'fjalekalim123'
+# main.py's SECRET_KEY, to sign CSRF tokens with (see csrf_token)
+SECRET_KEY = 'SECRET KEY'
+ADMIN = ('admin@gmail.com', '12345678')
+
+
+class User:
+    """One virtual user: a client with its own cookies, and what the routes need to know about the catalog."""
+
+    def __init__(self, url, number, catalog, run):
+        self.client = httpx.AsyncClient(base_url=url, timeout=120)
+        self.number = number
+        self.run = run
+        self.products = catalog['products']
+        self.farmer = catalog['farmers'][number % len(catalog['farmers'])]
+        self.email = catalog['emails'][self.farmer]
+
+    def product(self, i):
+        return self.products[(self.number + i) % len(self.products)]
+
+    def session_id(self, i):
+        # New in every run: a paid session is only processed (line items listed, farmers emailed) once
+        return f'cs_bench_{self.run}_{self.number}_{i}'
+
+
+def csrf_token(user):
+    """Give ``user`` a session holding a CSRF secret and return the form token for it, as Flask-WTF would.
+
+    The app's own forms cannot hand one out: their templates import Flask-Bootstrap's
+    ``bootstrap/wtf.html``, which the pinned Bootstrap-Flask does not ship.
+    """
+    secret = hashlib.sha1(os.urandom(64)).hexdigest()
+    signer = Flask(__name__)
+    signer.secret_key = SECRET_KEY
+    user.client.cookies.set('session', SecureCookieSessionInterface().get_signing_serializer(signer).dumps(
+        {'csrf_token': secret}))
+    return URLSafeTimedSerializer(SECRET_KEY, salt='wtf-csrf-token').dumps(secret)
+
+
+async def log_in(user, email, password):
+    response = await user.client.post('/login', data={'csrf_token': csrf_token(user), 'email': email,
+                                                      'password': password})
+    if response.headers.get('location') != '/home':
+        raise RuntimeError(f"Could not log in as {email}")
+
+
+async def log_in_farmer(user):
+    await log_in(user, user.email, PASSWORD)
+
+
+async def log_in_admin(user):
+    await log_in(user, *ADMIN)
+
+
+async def fill_cart(user):
+    await user.client.post('/add-to-cart', data={'product_id': user.product(0), 'quantity': 2})
+
+
+async def fetch_login_token(user):
+    user.token = csrf_token(user)
+
+
+def get(path, params=None):
+    return lambda user, i: user.client.get(path, params=params(user, i) if params else None)
+
+
+def post(path, data=None):
+    return lambda user, i: user.client.post(path, data=data(user, i) if data else None)
+
+
+# Route name -> (setup run once per virtual user, request made in the measured loop)
+ROUTES = {
+    'home': (None, get('/home')),
+    'fruta': (None, get('/fruta')),
+    'perime': (None, get('/perime')),
+    'produkte_bulmeti': (None, get('/produkte_bulmeti')),
+    'produkte_shtazore': (None, get('/produkte_shtazore')),
+    'pije': (None, get('/pije')),
+    'tjera': (None, get('/tjera')),
+    'kerko': (None, get('/kerko', lambda user, i: {'q': WORDS[i % len(WORDS)]})),
+    'api-products': (None, get('/api/products', lambda user, i: {'category': CATEGORIES[i % len(CATEGORIES)]})),
+    'shiko-produktet': (None, lambda user, i: user.client.get(f'/shiko-produktet/{user.farmer}')),
+    'produktet-e-tua': (log_in_farmer, get('/produktet-e-tua')),
+    'perdoruesit': (log_in_admin, get('/perdoruesit')),
+    'login': (fetch_login_token, post('/login', lambda user, i: {'csrf_token': user.token, 'email': user.email,
+                                                                   'password': PASSWORD})),
+    'add-to-cart': (None, post('/add-to-cart', lambda user, i: {'product_id': user.product(i), 'quantity': 1})),
+    'cart': (fill_cart, get('/cart')),
+    'checkout': (fill_cart, get('/checkout')),
+    'create-checkout-session': (fill_cart, post('/create-checkout-session')),
+    'success': (None, get('/success', lambda user, i: {'session_id': user.session_id(i)})),
+    'session-status': (None, get('/session-status', lambda user, i: {'session_id': user.session_id(i)})),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def start_fake_stripe(products, latency, error_rate):
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_stripe.py'), '0',
+                                str(latency), str(products), str(error_rate)], stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def start_server(env):
+    port = free_port()
+    command = ['-m', 'flask', '--app', 'main', 'run', '--port', str(port)]
+    process = subprocess.Popen([sys.executable, *command], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    while process.poll() is None:
+        try:
+            httpx.get(url + '/home', timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The app exited with status {process.returncode}")
+
+
+def load_catalog(url):
+    """Wait for the first catalog sync, then pick the products and farmers the virtual users work with."""
+    while True:
+        # Until the sync is done the app answers from the (empty) replica, flagged as stale
+        response = httpx.get(url + '/api/products', params={'limit': 100, 'fields': 'id,farmer'}, timeout=60)
+        response.raise_for_status()
+        page = response.json()
+        if page['data'] and not page['stale']:
+            break
+        time.sleep(0.5)
+    rows = page['data']
+    farmers = sorted({row['farmer'] for row in rows})
+    return {'products': [row['id'] for row in rows], 'farmers': farmers,
+            'emails': {farmer: f"{farmer.lower().replace(' ', '')}@example.com" for farmer in farmers}}
+
+
+def seed_accounts(database, catalog):
+    # Farmer accounts go straight into the database: registering through the form checks the
+    # email's domain over DNS. The admin is created by the app's own /create-admin route.
+    stored = generate_password_hash(PASSWORD, method='pbkdf2:sha256:600000', salt_length=16)
+    with sqlite3.connect(database) as connection:
+        connection.executemany(
+            'INSERT INTO Perdoruesit (name, email, password, role) VALUES (?, ?, ?, ?)',
+            [(farmer, email, stored, 'Fermer') for farmer, email in catalog['emails'].items()])
+
+
+async def stripe_stats(stripe_url):
+    async with httpx.AsyncClient() as client:
+        return (await client.get(stripe_url + '/_fake/stats')).json()
+
+
+async def measure(url, stripe_url, pid, catalog, route, concurrency, seconds):
+    setup, send = ROUTES[route]
+    users = [User(url, number, catalog, run=concurrency) for number in range(concurrency)]
+    latencies = []
+    errors = 0
+    try:
+        if setup is not None:
+            await asyncio.gather(*(setup(user) for user in users))
+        before = await stripe_stats(stripe_url)
+        cpu = cpu_seconds(pid)
+        deadline = time.perf_counter() + seconds
+
+        async def worker(user):
+            nonlocal errors
+            i = 0
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await send(user, i)
+                    errors += response.status_code >= 400
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+                i += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(user) for user in users))
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(pid) - cpu
+        after = await stripe_stats(stripe_url)
+    finally:
+        for user in users:
+            await user.client.aclose()
+    requests = max(len(latencies), 1)
+    return {
+        'route': route,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1e3, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1e3, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1e3, 2),
+        'stripe_calls_per_request': round((after['requests'] - before['requests']) / requests, 3),
+        'cpu_ms_per_request': round(cpu / requests * 1e3, 2),
+    }
+
+
+def compare(results, settings, baseline, tolerance):
+    """Print the change against ``baseline`` for each row; returns the rows that got worse."""
+    previous = {(row['route'], row['concurrency']): row for row in baseline['results']}
+    regressions = []
+    differences = [f"{name} {baseline['settings'].get(name)} -> {settings[name]}"
+                   for name in ('products', 'seconds', 'stripe_latency', 'stripe_error_rate')
+                   if baseline['settings'].get(name) != settings[name]]
+    if differences:
+        print(f"\nNote: the baseline ran with different settings ({', '.join(differences)})")
+    print(f"\n{'route':>24} {'conc':>5} {'p95 change':>11} {'req/s change':>13}")
+    for row in results:
+        old = previous.get((row['route'], row['concurrency']))
+        if old is None:
+            continue
+        p95 = row['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0.0
+        throughput = row['throughput'] / old['throughput'] - 1 if old['throughput'] else 0.0
+        worse = p95 > tolerance or throughput < -tolerance
+        if worse:
+            regressions.append(row)
+        print(f"{row['route']:>24} {row['concurrency']:>5} {p95:>+10.1%} {throughput:>+12.1%}"
+              f"{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--products', type=int, default=5000, help='size of the synthetic catalog')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated requests in flight')
+    parser.add_argument('--seconds', type=float, default=5, help='measuring time per route and level')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma-separated routes: ' + ', '.join(ROUTES))
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake Stripe takes per call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of Stripe calls that fail')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown before a regression')
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+    args.routes = args.routes.split(',')
+    unknown = [route for route in args.routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+    return args
+
+
+def run():
+    args = parse_args()
+    sink = FakeSMTP().start()
+    fake, stripe_url = start_fake_stripe(args.products, args.latency, args.error_rate)
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    env = dict(os.environ,
+               DB_URI='sqlite:///' + database,
+               STRIPE_API_BASE=stripe_url,
+               # Measure the app, not the rate limit meant for the real API
+               STRIPE_RATE_LIMIT='100000',
+               SMTP_HOST='127.0.0.1',
+               SMTP_PORT=str(sink.port),
+               SMTP_STARTTLS='0',
+               SMTP_USER='',
+               **{'SECRET KEY': 'sk_test_bench'})
+    server = None
+    try:
+        server, url = start_server(env)
+        started = time.perf_counter()
+        catalog = load_catalog(url)
+        print(f"{args.products} products synced in {time.perf_counter() - started:.1f}s; "
+              f"{args.latency * 1e3:.0f}ms per Stripe call, {args.error_rate:.0%} failing")
+        seed_accounts(database, catalog)
+        httpx.get(url + '/create-admin')
+
+        print(f"{'route':>24} {'conc':>5} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7} "
+              f"{'stripe/req':>11} {'cpu/req':>9}")
+        results = []
+        for route in args.routes:
+            for concurrency in args.concurrency:
+                row = asyncio.run(measure(url, stripe_url, server.pid, catalog, route, concurrency, args.seconds))
+                results.append(row)
+                print(f"{route:>24} {concurrency:>5} {row['throughput']:>8.1f} {row['p50_ms']:>7.1f}ms "
+                      f"{row['p95_ms']:>7.1f}ms {row['p99_ms']:>7.1f}ms {row['errors']:>7} "
+                      f"{row['stripe_calls_per_request']:>11.3f} {row['cpu_ms_per_request']:>7.2f}ms")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        fake.terminate()
+        sink.stop()
+
+    report = {
+        'settings': {
+            'commit': git_commit(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'products': args.products,
+            'seconds': args.seconds,
+            'stripe_latency': args.latency,
+            'stripe_error_rate': args.error_rate,
+            'emails_sent': sink.messages,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, report['settings'], json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
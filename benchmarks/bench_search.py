@@ -0,0 +1,59 @@
+"""Benchmark: /kerko substring scan vs. the SearchIndex.
+
+Run from the repository root:
+
+    python benchmarks/bench_search.py
+
+For growing synthetic catalogs it reports the old per-search cost (a
+lowercase substring test against every product name) next to an indexed
+whole-word query and an indexed prefix query.
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex  # noqa: E402
+
+CATEGORIES = ('Bulmet', 'Shtazore', 'Fruta', 'Perime', 'Pije', 'Tjera')
+WORDS = ('mollë', 'dardhë', 'djathë', 'qumësht', 'mjaltë', 'verë', 'rrush', 'domate', 'kastravec', 'spinaq',
+         'gjizë', 'kos', 'mish', 'vezë', 'lëng', 'çaj', 'arra', 'fiq', 'ftua', 'hurma', 'bio', 'fshati', 'i freskët')
+
+
+def synthetic_rows(size):
+    # Names pair a common word with a variety/brand name; a real catalog gains new
+    # varieties as it grows, so the number of distinct ones grows with the size
+    rng = random.Random(size)
+    syllables = ('ka', 'ro', 'me', 'li', 'sa', 'to', 'ne', 'vu', 'shi', 'dra', 'gje', 'zo')
+    varieties = sorted({''.join(rng.choice(syllables) for _ in range(3)) for _ in range(size // 4)})
+    return [{
+        'id': f'prod_{i}',
+        'name': f"{rng.choice(WORDS)} {rng.choice(varieties)}",
+        'description': ' '.join(rng.choice(WORDS) for _ in range(8)),
+        'category': rng.choice(CATEGORIES),
+    } for i in range(size)]
+
+
+def scan(rows, query):
+    query = query.lower()
+    return [row for row in rows if query in row['name'].lower()]
+
+
+def main():
+    print(f"{'products':>9} {'scan':>10} {'token':>10} {'prefix':>10} {'index build':>12}")
+    for size in (1000, 5000, 10000, 50000):
+        rows = synthetic_rows(size)
+        build = min(timeit.repeat(lambda: SearchIndex().sync(rows), number=1, repeat=1))
+        index = SearchIndex()
+        index.sync(rows)
+        scan_time = min(timeit.repeat(lambda: scan(rows, 'karome'), number=10, repeat=3)) / 10
+        token = min(timeit.repeat(lambda: index.search('karome', limit=60), number=10, repeat=3)) / 10
+        prefix = min(timeit.repeat(lambda: index.search('djathe karo', limit=60), number=10, repeat=3)) / 10
+        print(f"{size:>9} {scan_time * 1e3:>8.2f}ms {token * 1e3:>8.2f}ms {prefix * 1e3:>8.2f}ms "
+              f"{build * 1e3:>10.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
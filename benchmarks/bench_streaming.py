@@ -0,0 +1,99 @@
+"""Benchmark: time to first byte of a buffered vs. a streamed product listing.
+
+Run from the repository root:
+
+    python benchmarks/bench_streaming.py [products]
+
+A synthetic catalog (one farmer, one category) is written to a throwaway
+SQLite database, and the farmer's listing is rendered with a cold catalog
+cache. The buffered version is the old route body: load the catalog, then
+``render_template``. The streamed version is the current
+``/shiko-produktet`` route. For each one the time to the first chunk, the
+time to the last chunk and the peak memory allocated while responding are
+reported.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DB_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from flask import render_template  # noqa: E402
+
+import main  # noqa: E402
+
+FARMER = 'Fermer 0'
+DESCRIPTION = 'Prodhim vendor, i freskët dhe pa kimikate. ' * 4
+
+
+def populate(size):
+    main.db.session.add_all(
+        main.Product(id=f'prod_{i}', name=f'Produkt {i}', description=DESCRIPTION,
+                     image=f'https://example.com/{i}.jpg', category='Fruta', farmer=FARMER, active=True, created=i)
+        for i in range(size)
+    )
+    main.db.session.add_all(
+        main.Price(id=f'price_{i}', product_id=f'prod_{i}', unit_amount=100 + i, currency='all', active=True,
+                   created=i)
+        for i in range(size)
+    )
+    main.db.session.commit()
+
+
+def buffered():
+    with main.app.test_request_context(f'/shiko-produktet/{FARMER}'):
+        main.catalog_cache.invalidate()
+        start = time.perf_counter()
+        html = render_template('produktet-admin.html', products=main.get_catalog().farmer(FARMER), farmer=FARMER)
+        elapsed = time.perf_counter() - start
+    # The whole page is the first (and only) chunk
+    return elapsed, elapsed, len(html)
+
+
+def streamed(client):
+    main.catalog_cache.invalidate()
+    start = time.perf_counter()
+    response = client.get(f'/shiko-produktet/{FARMER}', buffered=False)
+    chunks = iter(response.response)
+    size = len(next(chunks))
+    first = time.perf_counter() - start
+    for chunk in chunks:
+        size += len(chunk)
+    last = time.perf_counter() - start
+    response.close()
+    return first, last, size
+
+
+def measure(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        first, last, size = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if best is None or first < best[0]:
+            best = (first, last, size, peak)
+    return best
+
+
+def run():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # Serve the catalog from the replica only; never list it from Stripe
+    main.app.config['STRIPE_WEBHOOK_SECRET'] = 'whsec_bench'
+    with main.app.app_context():
+        populate(size)
+    client = main.app.test_client()
+
+    print(f"{size} products, cold catalog cache")
+    print(f"{'':>10} {'first byte':>12} {'last byte':>12} {'page':>10} {'peak memory':>12}")
+    for name, fn in (('buffered', buffered), ('streamed', lambda: streamed(client))):
+        first, last, page, peak = measure(fn)
+        print(f"{name:>10} {first * 1e3:>10.1f}ms {last * 1e3:>10.1f}ms {page / 1024:>8.0f}KB {peak / 1024:>10.0f}KB")
+
+
+if __name__ == '__main__':
+    run()
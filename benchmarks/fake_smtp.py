@@ -0,0 +1,78 @@
+"""A local SMTP server that accepts every message and discards it, for benchmarks.
+
+    sink = FakeSMTP().start()
+    # SMTP_HOST=127.0.0.1 SMTP_PORT=<sink.port> SMTP_STARTTLS=0 SMTP_USER=
+
+or on its own:
+
+    python benchmarks/fake_smtp.py [port]
+
+It speaks just enough SMTP for smtplib (no TLS, no authentication, so
+leave ``SMTP_USER`` empty) and counts the messages it receives.
+"""
+import socketserver
+import sys
+import threading
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _reply(self, *lines):
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode('ascii'))
+
+    def handle(self):
+        self._reply('220 fake-smtp ready')
+        for line in self.rfile:
+            command = line.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self._reply('250-fake-smtp', '250-8BITMIME', '250 SMTPUTF8')
+            elif command == 'DATA':
+                self._reply('354 end data with <CR><LF>.<CR><LF>')
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                with self.server.lock:
+                    self.server.messages += 1
+                self._reply('250 queued')
+            elif command == 'QUIT':
+                self._reply('221 bye')
+                return
+            elif command in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self._reply('250 ok')
+            else:
+                self._reply('502 not implemented')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSMTP:
+    """Accepts mail on ``127.0.0.1`` from a background thread."""
+
+    def __init__(self, port=0):
+        self.server = _Server(('127.0.0.1', port), _Handler)
+        self.server.messages = 0
+        self.server.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def messages(self):
+        return self.server.messages
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-smtp', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    sink = FakeSMTP(port=int(sys.argv[1]) if len(sys.argv) > 1 else 2525)
+    print(sink.port, flush=True)
+    sink.server.serve_forever()
@@ -0,0 +1,364 @@
+"""A local stand-in for the Stripe API, for benchmarks and offline load tests.
+
+Implements the parts of the API the app uses. Each call is answered after
+``latency`` seconds, plus up to ``jitter`` more, like a remote API would:
+
+- listing products and prices, with ``limit``/``starting_after``
+  pagination and the ``active``/``product`` filters;
+- creating and updating products and prices, which records the catalog
+  events a later ``/v1/events`` listing returns;
+- creating and retrieving Checkout Sessions and listing their line items.
+
+A fraction ``error_rate`` of calls fails with ``error_status``: 500 by
+default, 429 to imitate rate limiting.
+
+    server = FakeStripe(latency=0.2, catalog=synthetic_catalog.generate(5000)).start()
+    stripe.api_base = server.url
+
+or on its own, so its threads do not compete with the app for the GIL:
+
+    python benchmarks/fake_stripe.py [port] [latency] [products] [error rate]
+
+Without a catalog it holds one product, ``prod_0``, with the price
+``price_0``. Sessions are paid as soon as they are created. A session id the
+server has not seen is answered as a paid session for one unit of the first
+price.
+
+``GET /_fake/stats`` returns the number of calls per endpoint. ``POST
+/_fake/config`` with a JSON body changes ``latency``, ``jitter``,
+``error_rate`` or ``error_status`` of a running server.
+"""
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+PRODUCT = {'id': 'prod_0', 'object': 'product', 'name': 'Mollë', 'description': 'Mollë e kuqe', 'images': [],
+           'metadata': {'Category': 'Fruta', 'Fermeri': 'Fermer'}, 'active': True, 'created': 1700000000}
+PRICE = {'id': 'price_0', 'object': 'price', 'product': 'prod_0', 'unit_amount': 12000, 'currency': 'all',
+         'active': True, 'created': 1700000000}
+SETTINGS = ('latency', 'jitter', 'error_rate', 'error_status')
+
+
+def stripe_list(url, data, has_more=False):
+    return {'object': 'list', 'url': url, 'has_more': has_more, 'data': data}
+
+
+def stripe_error(status, message):
+    kind = 'rate_limit_error' if status == 429 else 'invalid_request_error' if status < 500 else 'api_error'
+    return {'error': {'type': kind, 'message': message}}
+
+
+def decode_params(query):
+    """Stripe's form encoding (``metadata[Category]=Fruta``, ``line_items[0][price]=...``) as dicts and lists."""
+    params = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        target = params
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return _as_lists(params)
+
+
+def _as_lists(value):
+    if not isinstance(value, dict):
+        return value
+    value = {key: _as_lists(item) for key, item in value.items()}
+    if value and all(key.isdigit() for key in value):
+        return [value[key] for key in sorted(value, key=int)]
+    return value
+
+
+def flag(value, default=None):
+    # The Python SDK sends booleans as 'True'/'False'
+    return default if value is None else str(value).lower() == 'true'
+
+
+def endpoint(method, path):
+    """``GET /v1/products/prod_12`` -> ``GET /v1/products/:id``, for counting calls."""
+    return f"{method} {re.sub(r'/(prod|price|cs|evt)_[^/]+', '/:id', path)}"
+
+
+class _Collection:
+    """Objects by id in creation order, with the position of each for ``starting_after``."""
+
+    def __init__(self, objects=()):
+        self.objects = {}
+        self.order = []
+        self.positions = {}
+        for obj in objects:
+            self.add(obj)
+
+    def add(self, obj):
+        if obj['id'] not in self.objects:
+            self.positions[obj['id']] = len(self.order)
+            self.order.append(obj['id'])
+        self.objects[obj['id']] = obj
+
+    def page(self, url, params, match=lambda obj: True):
+        limit = int(params.get('limit', 10))
+        after = params.get('starting_after')
+        position = self.positions[after] + 1 if after in self.positions else 0
+        data = []
+        while position < len(self.order) and len(data) <= limit:
+            obj = self.objects[self.order[position]]
+            if match(obj):
+                data.append(obj)
+            position += 1
+        return stripe_list(url, data[:limit], has_more=len(data) > limit)
+
+
+class StripeState:
+    """The fake account: catalog, catalog events and Checkout Sessions."""
+
+    def __init__(self, products, prices):
+        self.products = _Collection(products)
+        self.prices = _Collection(prices)
+        self.events = _Collection()
+        self.sessions = {}
+        self.line_items = {}
+        self.lock = threading.Lock()
+        self._ids = 0
+
+    def _id(self, prefix):
+        self._ids += 1
+        return f'{prefix}_fake{self._ids}'
+
+    def _event(self, kind, obj):
+        now = int(time.time())
+        self.events.add({'id': self._id('evt'), 'object': 'event', 'type': kind, 'created': now,
+                         'data': {'object': dict(obj)}})
+
+    def list_events(self, params):
+        types = set(params.get('types') or ())
+        since = int((params.get('created') or {}).get('gte', 0))
+        return self.events.page('/v1/events', params,
+                                lambda event: (not types or event['type'] in types) and event['created'] >= since)
+
+    def list_products(self, params):
+        active = flag(params.get('active'))
+        return self.products.page('/v1/products', params,
+                                  lambda product: active is None or product['active'] == active)
+
+    def list_prices(self, params):
+        active = flag(params.get('active'))
+        product = params.get('product')
+        return self.prices.page('/v1/prices', params,
+                                lambda price: (active is None or price['active'] == active)
+                                and (product is None or price['product'] == product))
+
+    def save_product(self, params, product_id=None):
+        now = int(time.time())
+        product = dict(self.products.objects[product_id]) if product_id else {
+            'id': self._id('prod'), 'object': 'product', 'name': '', 'description': None, 'images': [],
+            'metadata': {}, 'active': True, 'created': now}
+        for field in ('name', 'description'):
+            if field in params:
+                product[field] = params[field]
+        if 'images' in params:
+            product['images'] = list(params['images'] or [])
+        product['active'] = flag(params.get('active'), product['active'])
+        product['metadata'] = {**product['metadata'], **(params.get('metadata') or {})}
+        product['updated'] = now
+        self.products.add(product)
+        self._event('product.updated' if product_id else 'product.created', product)
+        return product
+
+    def save_price(self, params, price_id=None):
+        price = dict(self.prices.objects[price_id]) if price_id else {
+            'id': self._id('price'), 'object': 'price', 'product': params.get('product'),
+            'unit_amount': int(params.get('unit_amount', 0)), 'currency': params.get('currency', 'all').lower(),
+            'active': True, 'created': int(time.time())}
+        price['active'] = flag(params.get('active'), price['active'])
+        self.prices.add(price)
+        self._event('price.updated' if price_id else 'price.created', price)
+        return price
+
+    def create_session(self, params):
+        session_id = self._id('cs_test')
+        lines = []
+        total = 0
+        for number, item in enumerate(params.get('line_items') or ()):
+            price = self.prices.objects.get(item.get('price'))
+            if price is None:
+                return None
+            quantity = int(item.get('quantity', 1))
+            total += price['unit_amount'] * quantity
+            lines.append({'id': f'li_{number}', 'object': 'item', 'quantity': quantity, 'price': price,
+                          'amount_total': price['unit_amount'] * quantity})
+        session = self.checkout_session(session_id, params.get('metadata') or {}, total)
+        self.sessions[session_id] = session
+        self.line_items[session_id] = lines
+        return session
+
+    @staticmethod
+    def checkout_session(session_id, metadata=None, total=0):
+        return {
+            'id': session_id,
+            'object': 'checkout.session',
+            'status': 'complete',
+            'payment_status': 'paid',
+            'amount_total': total,
+            'url': f'https://checkout.stripe.com/c/pay/{session_id}',
+            'customer_details': {'email': 'bleresi@example.com'},
+            'metadata': metadata or {},
+        }
+
+    def session(self, session_id):
+        return self.sessions.get(session_id) or self.checkout_session(session_id)
+
+    def session_line_items(self, session_id):
+        lines = self.line_items.get(session_id)
+        if lines is None:
+            price = self.prices.objects[self.prices.order[0]]
+            lines = [{'id': 'li_0', 'object': 'item', 'quantity': 1, 'price': price,
+                      'amount_total': price['unit_amount']}]
+        return stripe_list(f'/v1/checkout/sessions/{session_id}/line_items', lines)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this each response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        path, _, query = self.path.partition('?')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        server = self.server
+        if path.startswith('/_fake/'):
+            return self._send(server.control(method, path, body))
+
+        name = endpoint(method, path)
+        with server.lock:
+            server.requests += 1
+            server.calls[name] = server.calls.get(name, 0) + 1
+            delay = server.latency + server.rng.random() * server.jitter
+            failed = server.rng.random() < server.error_rate
+            if failed:
+                server.errors += 1
+        time.sleep(delay)
+        if failed:
+            return self._send(stripe_error(server.error_status, 'Injected failure'), server.error_status)
+        params = decode_params(body if method == 'POST' else query)
+        with server.state.lock:
+            result = self._route(server.state, method, path, params)
+        if result is None:
+            return self._send(stripe_error(404, f'No such object: {path}'), 404)
+        self._send(result)
+
+    @staticmethod
+    def _route(state, method, path, params):
+        if method == 'GET':
+            lists = {'/v1/products': state.list_products, '/v1/prices': state.list_prices,
+                     '/v1/events': state.list_events}
+            if path in lists:
+                return lists[path](params)
+            match = re.fullmatch(r'/v1/checkout/sessions/([^/]+)(/line_items)?', path)
+            if match:
+                return state.session_line_items(match.group(1)) if match.group(2) else state.session(match.group(1))
+            match = re.fullmatch(r'/v1/(products|prices)/([^/]+)', path)
+            if match:
+                return getattr(state, match.group(1)).objects.get(match.group(2))
+            return None
+        if path == '/v1/checkout/sessions':
+            return state.create_session(params)
+        match = re.fullmatch(r'/v1/(products|prices)(?:/([^/]+))?', path)
+        if match is None:
+            return None
+        kind, object_id = match.groups()
+        if object_id is not None and object_id not in getattr(state, kind).objects:
+            return None
+        save = state.save_product if kind == 'products' else state.save_price
+        return save(params, object_id)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def control(self, method, path, body):
+        if method == 'POST' and path == '/_fake/config':
+            settings = json.loads(body or '{}')
+            with self.lock:
+                for name in SETTINGS:
+                    if name in settings:
+                        setattr(self, name, type(getattr(self, name))(settings[name]))
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'calls': dict(self.calls),
+                    **{name: getattr(self, name) for name in SETTINGS}}
+
+
+class FakeStripe:
+    """Serves the fake API on ``127.0.0.1`` from a background thread.
+
+    ``catalog`` is a ``(products, prices)`` pair such as
+    ``synthetic_catalog.generate()`` returns.
+    """
+
+    def __init__(self, latency=0.2, port=0, catalog=None, jitter=0.0, error_rate=0.0, error_status=500, seed=0):
+        products, prices = catalog or ([PRODUCT], [PRICE])
+        self.server = _Server(('127.0.0.1', port), _Handler)
+        self.server.state = StripeState(products, prices)
+        self.server.latency = float(latency)
+        self.server.jitter = float(jitter)
+        self.server.error_rate = float(error_rate)
+        self.server.error_status = int(error_status)
+        self.server.rng = random.Random(seed)
+        self.server.requests = 0
+        self.server.errors = 0
+        self.server.calls = {}
+        self.server.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def stats(self):
+        return self.server.control('GET', '/_fake/stats', '')
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-stripe', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    catalog = None
+    if len(sys.argv) > 3:
+        from synthetic_catalog import generate
+        catalog = generate(int(sys.argv[3]))
+    fake = FakeStripe(latency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.2,
+                      port=int(sys.argv[1]) if len(sys.argv) > 1 else 12111,
+                      catalog=catalog,
+                      error_rate=float(sys.argv[4]) if len(sys.argv) > 4 else 0.0)
+    print(fake.url, flush=True)
+    fake.server.serve_forever()
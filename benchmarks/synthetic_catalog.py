@@ -0,0 +1,67 @@
+"""Synthetic Stripe catalogs for benchmarks: products and prices as the API returns them.
+
+    products, prices = generate(5000)
+
+or as JSON, e.g. to inspect what a benchmark runs against:
+
+    python benchmarks/synthetic_catalog.py [products] [farmers] > catalog.json
+
+Products are spread over the six categories the shop has pages for, and
+over ``farmers`` farmers (by default one per 20 products, at least 5).
+Names and descriptions are built from Albanian produce words so searches
+find something. Every product has one active price; a tenth of them also
+have an older, inactive one, as after a farmer changed the price. The same
+arguments always give the same catalog.
+"""
+import json
+import random
+import sys
+
+CATEGORIES = ('Bulmet', 'Shtazore', 'Fruta', 'Perime', 'Pije', 'Tjera')
+WORDS = ('mollë', 'dardhë', 'djathë', 'qumësht', 'mjaltë', 'verë', 'rrush', 'domate', 'kastravec', 'spinaq',
+         'vezë', 'gjalpë', 'kos', 'mish', 'qershi', 'kumbull', 'fiq', 'arra', 'lajthi', 'raki')
+ADJECTIVES = ('i freskët', 'vendor', 'organik', 'i zgjedhur', 'shtëpie', 'malor')
+START = 1700000000
+
+
+def farmer_name(number):
+    return f'Fermer {number}'
+
+
+def default_farmers(size):
+    return max(5, size // 20)
+
+
+def generate(size, farmers=None, seed=0):
+    """``size`` products and their prices, shaped like Stripe list results."""
+    farmers = default_farmers(size) if farmers is None else farmers
+    rng = random.Random(seed * 1000003 + size)
+    products, prices = [], []
+    for i in range(size):
+        word = rng.choice(WORDS)
+        created = START + i * 60
+        products.append({
+            'id': f'prod_{i}',
+            'object': 'product',
+            'name': f'{word.capitalize()} {rng.choice(ADJECTIVES)} {i}',
+            'description': f'{word.capitalize()} nga {farmer_name(i % farmers)}, {rng.choice(ADJECTIVES)}.',
+            'images': [f'https://example.com/images/{i}.jpg'] if i % 3 else [],
+            'metadata': {'Category': CATEGORIES[i % len(CATEGORIES)], 'Fermeri': farmer_name(i % farmers)},
+            'active': True,
+            'created': created,
+            'updated': created,
+        })
+        if i % 10 == 0:
+            prices.append({'id': f'price_{i}_old', 'object': 'price', 'product': f'prod_{i}',
+                           'unit_amount': rng.randint(1, 500) * 100, 'currency': 'all', 'active': False,
+                           'created': created})
+        prices.append({'id': f'price_{i}', 'object': 'price', 'product': f'prod_{i}',
+                       'unit_amount': rng.randint(1, 500) * 100, 'currency': 'all', 'active': True,
+                       'created': created + 1})
+    return products, prices
+
+
+if __name__ == '__main__':
+    products, prices = generate(int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+                                int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    json.dump({'products': products, 'prices': prices}, sys.stdout, ensure_ascii=False)
@@ -0,0 +1,133 @@
+"""Circuit breaker for calls to a remote service (Stripe).
+
+While Stripe is slow or down, every request that calls it waits for the
+SDK's timeout and then fails, and those waiting requests tie up the worker
+threads. ``CircuitBreaker`` counts consecutive failed or slow calls. After
+``failure_threshold`` of them it *opens*: calls fail at once with
+:class:`CircuitOpen` and callers fall back to what they have locally. After
+``reset_timeout`` seconds one trial call is let through (*half-open*). If it
+succeeds the breaker closes again. If it fails, the breaker re-opens and
+waits twice as long before the next trial, up to ``max_reset_timeout``.
+
+Only errors of ``failure_types`` count against the service. Anything else
+(a declined card, an unknown session id) is the caller's problem and counts
+as a successful call.
+"""
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(RuntimeError):
+    """Raised instead of calling the service while the breaker is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with exponential back-off between half-open trials."""
+
+    def __init__(self, name='service', failure_threshold=5, slow_call=2.0, reset_timeout=5.0,
+                 max_reset_timeout=300.0, failure_types=(Exception,)):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.failure_types = failure_types
+        self.state = CLOSED
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Take permission for one call; False while open (or while a half-open trial is running)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self._open_until:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        """Seconds until the next trial call may be made (0 when closed)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            return max(0.0, self._open_until - time.monotonic())
+
+    def record(self, duration, failed=False):
+        """Report the outcome of a call that :meth:`allow` let through."""
+        slow = self.slow_call is not None and duration > self.slow_call
+        with self._lock:
+            self.calls += 1
+            self.failures += failed
+            self.slow_calls += slow and not failed
+            probe = self._probing
+            self._probing = False
+            if not (failed or slow):
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                self.reset_timeout = self.base_reset_timeout
+                return
+            self.consecutive_failures += 1
+            if probe:
+                # The trial call failed too: back off for longer before the next one
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        # Called with the lock held
+        self.state = OPEN
+        self.opened += 1
+        self._open_until = time.monotonic() + self.reset_timeout
+
+    def _rejection(self):
+        return CircuitOpen(self.name, self.retry_after())
+
+    def call(self, fn, *args, **kwargs):
+        """Call ``fn`` through the breaker; raises :class:`CircuitOpen` instead while it is open."""
+        if not self.allow():
+            raise self._rejection()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except self.failure_types:
+            self.record(time.monotonic() - start, failed=True)
+            raise
+        except BaseException:
+            self.record(time.monotonic() - start)
+            raise
+        self.record(time.monotonic() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'calls': self.calls,
+                'failures': self.failures,
+                'slow_calls': self.slow_calls,
+                'rejected': self.rejected,
+                'opened': self.opened,
+                'reset_timeout': self.reset_timeout,
+            }
@@ -0,0 +1,182 @@
+"""Server-side shopping carts.
+
+The browser only holds a short random ``cart_id`` cookie. Cart lines live in
+the ``Cart``/``CartLine`` tables, and each line keeps just the product id,
+price id, quantity and unit amount. ``CartStore`` puts a small LRU of
+recently used carts in front of the database and keeps each cart's total
+and item count up to date as lines change, so a cart view never has to sum
+its lines. Carts left untouched for longer than the TTL are deleted by a
+background reaper.
+
+The LRU is per process, so another worker process may change a cached cart.
+Every read therefore still fetches the cart's own row and reloads the lines
+when its total, item count or time of last change differ from the cached
+copy; the cache saves reading the lines.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import delete, select, update
+
+
+class CartState:
+    """The cached contents of one cart; amounts are in the smallest currency unit."""
+
+    __slots__ = ('id', 'lines', 'total', 'count', 'updated_at')
+
+    def __init__(self, cart_id, lines=None, total=0, count=0, updated_at=0):
+        self.id = cart_id
+        self.lines = lines if lines is not None else {}
+        self.total = total
+        self.count = count
+        self.updated_at = updated_at
+
+
+class CartStore:
+    def __init__(self, app, db, cart_model, line_model, max_cached=1024, ttl=7 * 24 * 3600, reap_interval=600):
+        self.app = app
+        self.db = db
+        self.Cart = cart_model
+        self.Line = line_model
+        self.max_cached = max_cached
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    # ------------------------------------------------------------------ cache
+    def _cached(self, cart_id):
+        with self._lock:
+            state = self._cache.get(cart_id)
+            if state is not None:
+                self._cache.move_to_end(cart_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return state
+
+    def _remember(self, state):
+        if not self.max_cached:
+            return
+        with self._lock:
+            self._cache[state.id] = state
+            self._cache.move_to_end(state.id)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def _forget(self, cart_ids):
+        with self._lock:
+            for cart_id in cart_ids:
+                self._cache.pop(cart_id, None)
+
+    # ------------------------------------------------------------------ reads
+    def get(self, cart_id):
+        """Return the CartState for ``cart_id``, or None if there is no such cart."""
+        self._start_reaper()
+        if not cart_id:
+            return None
+        cart = self.db.session.execute(
+            select(self.Cart.id, self.Cart.total, self.Cart.count, self.Cart.updated_at).where(self.Cart.id == cart_id)
+        ).first()
+        if cart is None:
+            self._forget([cart_id])
+            return None
+        state = self._cached(cart_id)
+        # Another process may have changed the cart since it was cached
+        if state is not None and (state.total, state.count, state.updated_at) == (cart.total, cart.count,
+                                                                                   cart.updated_at):
+            return state
+
+        lines = self.db.session.scalars(select(self.Line).where(self.Line.cart_id == cart_id))
+        state = CartState(cart.id, {
+            line.product_id: {'price_id': line.price_id, 'quantity': line.quantity, 'unit_amount': line.unit_amount}
+            for line in lines
+        }, cart.total, cart.count, cart.updated_at)
+        self._remember(state)
+        return state
+
+    # ----------------------------------------------------------------- writes
+    def create(self):
+        state = CartState(secrets.token_urlsafe(16), updated_at=int(time.time()))
+        self.db.session.add(self.Cart(id=state.id, total=0, count=0, updated_at=state.updated_at))
+        self.db.session.commit()
+        self._remember(state)
+        return state
+
+    def _adjust(self, state, total_delta, count_delta):
+        # Apply the change to the stored totals in SQL and then to the cached copy
+        now = int(time.time())
+        self.db.session.execute(
+            update(self.Cart).where(self.Cart.id == state.id)
+            .values(total=self.Cart.total + total_delta, count=self.Cart.count + count_delta, updated_at=now)
+        )
+        self.db.session.commit()
+        state.total += total_delta
+        state.count += count_delta
+        state.updated_at = now
+
+    def add(self, state, product_id, price_id, unit_amount, quantity):
+        """Add ``quantity`` of a product, re-pricing the whole line at ``unit_amount``."""
+        line = self.db.session.get(self.Line, (state.id, product_id))
+        if line is None:
+            line = self.Line(cart_id=state.id, product_id=product_id, price_id=price_id,
+                             quantity=quantity, unit_amount=unit_amount)
+            self.db.session.add(line)
+            total_delta = quantity * unit_amount
+        else:
+            before = line.quantity * line.unit_amount
+            line.quantity += quantity
+            line.price_id = price_id
+            line.unit_amount = unit_amount
+            total_delta = line.quantity * unit_amount - before
+        state.lines[product_id] = {'price_id': price_id, 'quantity': line.quantity, 'unit_amount': unit_amount}
+        self._adjust(state, total_delta, quantity)
+
+    def remove(self, state, product_id):
+        line = state.lines.pop(product_id, None)
+        if line is None:
+            return
+        self.db.session.execute(
+            delete(self.Line).where(self.Line.cart_id == state.id, self.Line.product_id == product_id)
+        )
+        self._adjust(state, -line['quantity'] * line['unit_amount'], -line['quantity'])
+
+    def clear(self, state):
+        self.db.session.execute(delete(self.Line).where(self.Line.cart_id == state.id))
+        state.lines.clear()
+        self._adjust(state, -state.total, -state.count)
+
+    # ----------------------------------------------------------------- reaper
+    def reap(self):
+        """Delete carts not changed for ``ttl`` seconds; returns how many were removed."""
+        cutoff = int(time.time()) - self.ttl
+        expired = self.db.session.scalars(select(self.Cart.id).where(self.Cart.updated_at < cutoff)).all()
+        if expired:
+            self.db.session.execute(delete(self.Line).where(self.Line.cart_id.in_(expired)))
+            self.db.session.execute(delete(self.Cart).where(self.Cart.id.in_(expired)))
+            self.db.session.commit()
+            self._forget(expired)
+        return len(expired)
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_forever, name='cart-reaper', daemon=True)
+            self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            with self.app.app_context():
+                try:
+                    self.reap()
+                except Exception:
+                    self.app.logger.exception("Cart reaper failed")
@@ -0,0 +1,458 @@
+"""Process-local cache for the Stripe product catalog.
+
+Every storefront page needs the full product and price listings from Stripe.
+``iter_products``/``iter_prices`` stream those listings page by page,
+``CatalogIndex`` turns them into lookup tables, and ``CatalogCache`` keeps the
+result in memory for a short time so a page view does not cost any remote
+round trips. Views that change the catalog drop the cached copy straight away.
+"""
+import base64
+import bisect
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import stripe
+
+logger = logging.getLogger(__name__)
+
+# Largest ``limit`` the Stripe list endpoints accept.
+STRIPE_PAGE_SIZE = 100
+# Longest a consumer of prefetch() waits for the next item (a page request, retries included)
+PREFETCH_TIMEOUT = 120
+
+
+class LoadTimeout(TimeoutError):
+    """Raised by :meth:`CatalogCache.get` when a load takes longer than the caller will wait."""
+
+
+class _Flight:
+    """One in-progress load that concurrent callers wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CatalogCache:
+    """A bounded, thread-safe TTL cache with single-flight loading.
+
+    Entries are keyed by whatever the caller passes (``'catalog'``,
+    ``('prices', product_id)``, ...). When more than ``max_entries`` keys are
+    held, the least recently used one is evicted.
+
+    Concurrent misses for the same key share one call to the loader instead
+    of each fetching from Stripe. For ``stale_ttl`` seconds after an entry
+    expires it is still served while one background thread refreshes it.
+    A caller that passes ``timeout`` waits at most that long for a load; the
+    load itself carries on in the background and is cached when it finishes.
+    """
+
+    def __init__(self, ttl=60, max_entries=32, stale_ttl=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, timeout=None):
+        """Return the cached value for ``key``, calling ``loader()`` on a miss.
+
+        Raises :class:`LoadTimeout` if the value is not loaded within ``timeout`` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if expires + self.stale_ttl > now:
+                    self.stale_hits += 1
+                    if key not in self._flights:
+                        self._refresh_in_background(key, loader)
+                    return value
+
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            if timeout is None:
+                return self._load(key, loader, flight, generation)
+            self._load_in_background(key, loader, flight, generation)
+        if not flight.done.wait(timeout):
+            raise LoadTimeout(f"Loading {key!r} took longer than {timeout}s")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def peek(self, key):
+        """Return the cached value for ``key`` while it may still be served, without loading it."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] + self.stale_ttl > time.monotonic():
+                return entry[1]
+            return None
+
+    def _load(self, key, loader, flight, generation):
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                # A load that started before invalidate() may have read old data; hand it
+                # to the callers already waiting but do not cache it
+                if flight.error is None and generation == self._generation:
+                    self._store(key, flight.value)
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def _refresh_in_background(self, key, loader):
+        # Called with the lock held
+        flight = self._flights[key] = _Flight()
+        self.refreshes += 1
+        self._load_in_background(key, loader, flight, self._generation)
+
+    def _load_in_background(self, key, loader, flight, generation):
+        def load():
+            try:
+                self._load(key, loader, flight, generation)
+            except Exception:
+                logger.exception("Background load of %r failed", key)
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def _store(self, key, value):
+        # Called with the lock held
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Drop one entry, or the whole cache when ``key`` is None."""
+        with self._lock:
+            self._generation += 1
+            # Loads already running may have read old data: callers from now on start a fresh
+            # one, while those already waiting still get what their load returns
+            if key is None:
+                self._entries.clear()
+                self._flights.clear()
+            else:
+                self._entries.pop(key, None)
+                self._flights.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'refreshes': self.refreshes,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            }
+
+
+def product_row(product, price):
+    """Flatten a Stripe product and its price into the dict the templates render."""
+    metadata = product['metadata']
+    return {
+        'id': product['id'],
+        'name': product['name'],
+        'description': product['description'],
+        'image': product['images'][0] if product['images'] else None,
+        'price': price['unit_amount'] / 100,
+        'category': metadata.get('Category', 'Uncategorized'),
+        'farmer': metadata.get('Fermeri', ''),
+        'price_id': price['id'],
+        'created': product.get('created', 0),
+    }
+
+
+def sort_key(row):
+    """Newest first, ties broken by id: the order every catalog listing uses."""
+    return -row['created'], row['id']
+
+
+def encode_cursor(value):
+    raw = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of :func:`encode_cursor`; raises ValueError for anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return json.loads(raw)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset_page(rows, cursor=None, limit=24):
+    """One page of ``rows`` (in :func:`sort_key` order) after ``cursor``.
+
+    Returns the page and the cursor for the next one, or None on the last
+    page. The cursor names the last row shown rather than an offset, so
+    products added or removed meanwhile do not shift later pages.
+    """
+    start = 0
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            created, product_id = position['k']
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid cursor: {cursor!r}") from e
+        start = bisect.bisect_right(rows, (-created, product_id), key=sort_key)
+    page = rows[start:start + limit]
+    if start + limit >= len(rows):
+        return page, None
+    return page, encode_cursor({'k': [page[-1]['created'], page[-1]['id']]})
+
+
+def offset_page(rows, cursor=None, limit=24):
+    """Like :func:`keyset_page` for ranked results, which have no stable sort key."""
+    start = 0
+    if cursor:
+        position = decode_cursor(cursor)
+        try:
+            start = int(position['o'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    page = rows[start:start + limit]
+    if start + limit >= len(rows):
+        return page, None
+    return page, encode_cursor({'o': start + limit})
+
+
+class LazyRows:
+    """Catalog rows that are only looked up when a template starts iterating them.
+
+    A streamed page can then send its header before the catalog is loaded.
+    ``select`` receives nothing and returns the rows. With ``limit`` only the
+    first :func:`keyset_page` is produced, and ``next_cursor`` is set once
+    the rows have been iterated.
+    """
+
+    def __init__(self, select, limit=None):
+        self.select = select
+        self.limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        rows = self.select()
+        if self.limit is not None:
+            rows, self.next_cursor = keyset_page(rows, limit=self.limit)
+        return iter(rows)
+
+
+class CatalogIndex:
+    """Lookup tables over one snapshot of the catalog.
+
+    Built once per snapshot in a single pass over the product rows, so views
+    answer "product X", "products in category Y" and "products of
+    farmer Z" with dict lookups instead of nested scans. Every list is kept
+    in :func:`sort_key` order, ready for :func:`keyset_page`.
+
+    ``version`` is the catalog version the snapshot was read at (it grows
+    with every product or price change) and ``changed_at`` the Unix time of
+    that change; both are 0 when unknown. ``stale`` is set on a snapshot
+    served without a successful sync, e.g. while Stripe is unreachable.
+    """
+
+    def __init__(self, rows, version=0, changed_at=0, stale=False):
+        self.version = version
+        self.changed_at = changed_at
+        self.stale = stale
+        self.ordered = sorted(rows, key=sort_key)
+        self.rows = {}
+        self.by_category = {}
+        self.by_farmer = {}
+        for row in self.ordered:
+            self.rows[row['id']] = row
+            self.by_category.setdefault(row['category'], []).append(row)
+            self.by_farmer.setdefault(row['farmer'], []).append(row)
+
+    @classmethod
+    def from_stripe(cls, products, prices):
+        """Index raw Stripe listings, keeping active products with an active price."""
+        latest = {}
+        for price in prices:
+            if not price.get('active', True):
+                continue
+            current = latest.get(price['product'])
+            if current is None or price['created'] > current['created']:
+                latest[price['product']] = price
+
+        return cls(product_row(product, latest[product['id']]) for product in products
+                   if product.get('active', True) and product['id'] in latest)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, product_id):
+        return self.rows.get(product_id)
+
+    def category(self, category):
+        return self.by_category.get(category, [])
+
+    def farmer(self, name):
+        return self.by_farmer.get(name, [])
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+class Prefetch:
+    """The consumer side of :func:`prefetch`: an iterator that can be closed before it is started.
+
+    Closing (or running to the end, or failing) stops the producer, so it
+    does not keep a pool worker waiting on a full queue. A generator could
+    not do this: closing one that never started skips its ``finally``.
+    """
+
+    def __init__(self, items, stop, timeout):
+        self._items = items
+        self._stop = stop
+        self._timeout = timeout
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration
+        try:
+            item = self._items.get(timeout=self._timeout)
+        except queue.Empty:
+            self.close()
+            raise TimeoutError(f"No item from the producer in {self._timeout}s") from None
+        if item is _DONE:
+            self.close()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self.close()
+            raise item.error
+        return item
+
+    def close(self):
+        self._stop.set()
+
+    def __del__(self):
+        self.close()
+
+
+def prefetch(make_iterable, depth=STRIPE_PAGE_SIZE * 2, executor=None, timeout=PREFETCH_TIMEOUT):
+    """Iterate ``make_iterable()`` in the background, staying ``depth`` items ahead.
+
+    The producer starts immediately (on ``executor``'s pool when given, else
+    on its own thread), so the first page is already in flight when this
+    returns, and at most ``depth`` items are buffered at a time. Errors
+    raised by the producer are re-raised in the consumer, and so is a
+    TimeoutError when the producer sends nothing for ``timeout`` seconds.
+    Returns a :class:`Prefetch`; close it when giving up on it early.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in make_iterable():
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+        else:
+            put(_DONE)
+
+    if executor is not None:
+        executor.spawn(produce)
+    else:
+        threading.Thread(target=produce, daemon=True).start()
+    return Prefetch(items, stop, timeout)
+
+
+def paginate(list_method, params, executor=None):
+    """Yield every object of a Stripe list endpoint, one page request at a time.
+
+    This is what ``auto_paging_iter()`` does, except that each page request
+    goes through ``executor.call`` so it counts against the shared rate limit.
+    """
+    call = executor.call if executor is not None else (lambda fn, **kwargs: fn(**kwargs))
+    page = call(list_method, **params)
+    while True:
+        yield from page['data']
+        if not page['has_more']:
+            return
+        page = call(page.next_page)
+
+
+def iter_products(active=True, category=None, farmer=None, executor=None):
+    """Stream every product from Stripe, following pagination to the end.
+
+    ``active`` is filtered by Stripe itself; ``category`` and ``farmer`` are
+    metadata fields the list endpoint cannot filter on, so they are applied
+    here as the products stream past.
+    """
+    params = {'limit': STRIPE_PAGE_SIZE}
+    if active is not None:
+        params['active'] = active
+    products = prefetch(lambda: paginate(stripe.Product.list, params, executor), executor=executor)
+    if category is None and farmer is None:
+        return products
+    return (product for product in products
+            if (category is None or product['metadata'].get('Category', '') == category)
+            and (farmer is None or product['metadata'].get('Fermeri', '') == farmer))
+
+
+def iter_prices(active=True, product=None, executor=None):
+    """Stream every price from Stripe, following pagination to the end."""
+    params = {'limit': STRIPE_PAGE_SIZE}
+    if active is not None:
+        params['active'] = active
+    if product is not None:
+        params['product'] = product
+    return prefetch(lambda: paginate(stripe.Price.list, params, executor), executor=executor)
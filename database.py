@@ -0,0 +1,105 @@
+"""Engine and connection settings for the application database.
+
+By default the app runs on the SQLite file ``instance/perdoruesit.db``. In
+SQLite's default rollback-journal mode a writer locks readers out for the
+length of its transaction, so a burst of registrations stalls every page
+that reads the database. :func:`tune_sqlite` switches each connection to
+write-ahead logging, which lets readers keep going while one writer commits.
+It also sets a busy timeout, so a second writer waits for the lock instead
+of failing with "database is locked".
+
+A server database named in ``DB_URI`` (PostgreSQL, MySQL, ...) gets a bounded
+connection pool instead; see :func:`engine_options`.
+
+``create_all`` only creates missing tables, so :func:`create_indexes` and
+:func:`widen_columns` bring the tables of an existing database up to date
+with their models.
+"""
+import sqlite3
+
+from sqlalchemy import event, inspect, make_url, text
+
+
+def engine_options(uri, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, busy_timeout=5.0):
+    """``SQLALCHEMY_ENGINE_OPTIONS`` for ``uri``."""
+    if uri.startswith('sqlite'):
+        if make_url(uri).database in (None, '', ':memory:'):
+            # An in-memory database lives in one connection, which Flask-SQLAlchemy keeps in a StaticPool
+            return {}
+        # Connections to a local file are cheap; the pool mainly avoids re-running the pragmas
+        return {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_timeout': pool_timeout,
+            'connect_args': {'timeout': busy_timeout},
+        }
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        # Replace connections before the server's idle timeout closes them, and test each
+        # one on checkout so a restarted server does not fail the first request
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': True,
+    }
+
+
+def tune_sqlite(engine, busy_timeout=5.0, cache_size_kb=20000):
+    """Apply WAL mode and the other pragmas to every new connection of a SQLite ``engine``."""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only syncs at checkpoints and still cannot corrupt the database
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)}')
+        cursor.execute(f'PRAGMA cache_size=-{int(cache_size_kb)}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+
+def create_indexes(db):
+    """Create any index declared on a model that is missing from an existing table.
+
+    ``create_all`` only creates indexes together with new tables, so an index
+    added to a model later would never reach a database created before it.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def widen_columns(db):
+    """Lengthen every string column of an existing table that is shorter than its model says.
+
+    A password hash from newer settings can outgrow the old ``VARCHAR(100)``;
+    PostgreSQL and MySQL reject the longer value instead of storing it.
+    SQLite does not enforce string lengths, so there is nothing to do there.
+    """
+    engine = db.engine
+    if engine.dialect.name == 'sqlite':
+        return
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            lengths = {column['name']: getattr(column['type'], 'length', None)
+                       for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                length, current = getattr(column.type, 'length', None), lengths.get(column.name)
+                if length is None or current is None or current >= length:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                if engine.dialect.name in ('mysql', 'mariadb'):
+                    # MODIFY restates the whole column definition
+                    change = f"MODIFY {quote.quote(column.name)} {column_type}{'' if column.nullable else ' NOT NULL'}"
+                else:
+                    change = f'ALTER COLUMN {quote.quote(column.name)} TYPE {column_type}'
+                connection.execute(text(f'ALTER TABLE {quote.format_table(table)} {change}'))
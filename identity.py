@@ -0,0 +1,118 @@
+"""Cached user identities for Flask-Login.
+
+Flask-Login calls the ``user_loader`` on every request of a logged-in user,
+and that used to mean one ``Perdoruesit`` query per page view. Pages only
+need the user's id, name, email and role, so ``IdentityCache`` keeps these
+as small immutable :class:`Identity` records in a bounded TTL cache. Any
+insert, update or delete of a user row drops that user's entry once the
+transaction commits, so a role change or deleted account is seen on the
+next request and not after the TTL.
+
+The cache is per process. Changes made by another process (or by a bulk
+``UPDATE`` statement that bypasses the ORM) show up after at most ``ttl``
+seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+_MISSING = object()
+
+
+class Identity(UserMixin):
+    """The parts of a user that requests need, detached from any database session."""
+
+    __slots__ = ('id', 'name', 'email', 'role')
+
+    def __init__(self, id, name, email, role):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.role = role
+
+    def __repr__(self):
+        return f"<Identity {self.id} {self.name!r} {self.role}>"
+
+
+class IdentityCache:
+    """LRU of user id -> Identity (or None for an unknown id) with a TTL."""
+
+    def __init__(self, loader, ttl=300, max_entries=10000):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Bumped by invalidate(); a load that started before it must not store what it read
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the Identity for ``user_id``, loading it on a miss; None if there is no such user."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        identity = self.loader(user_id)
+        if self.max_entries:
+            with self._lock:
+                if generation != self._generation:
+                    return identity
+                self._entries[user_id] = (now + self.ttl, identity)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id=None):
+        """Drop one user's entry, or every entry when ``user_id`` is None."""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def watch(self, session, user_model):
+        """Invalidate users inserted, updated or deleted through ``session`` when it commits.
+
+        Inserts are watched too: SQLite may give a new user the id of a deleted
+        one, whose "no such user" entry must not outlive the registration.
+        """
+        def changed(mapper, connection, target):
+            user_session = object_session(target)
+            if user_session is not None:
+                user_session.info.setdefault('changed_users', set()).add(target.id)
+
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(user_model, name, changed)
+
+        @event.listens_for(session, 'after_commit')
+        def committed(committed_session):
+            for user_id in committed_session.info.pop('changed_users', ()):
+                self.invalidate(str(user_id))
+
+        @event.listens_for(session, 'after_soft_rollback')
+        def rolled_back(rolled_back_session, previous_transaction):
+            rolled_back_session.info.pop('changed_users', None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
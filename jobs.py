@@ -0,0 +1,124 @@
+"""Background job that removes a farmer account and their catalog.
+
+Deleting a farmer means deactivating every one of their products on Stripe
+before the user row goes away, which is far too slow for the admin's
+request once a farmer has a few hundred products. ``FarmerDeletionJobs``
+runs that work on a background thread instead. It lists the farmer's
+products from Stripe, deactivates them in batches on the shared Stripe pool
+and records progress in the ``DeletionJob`` table after every batch. A job
+interrupted by a crash or restart is picked up again by :meth:`resume`.
+"""
+import logging
+import threading
+import time
+
+import stripe
+from sqlalchemy import or_, select, update
+
+from catalog import iter_products
+
+logger = logging.getLogger(__name__)
+
+
+class FarmerDeletionJobs:
+    """Creates, runs and resumes ``DeletionJob`` rows."""
+
+    def __init__(self, app, db, job_model, user_model, replica, executor,
+                 batch_size=20, lease=120, on_catalog_change=None):
+        self.app = app
+        self.db = db
+        self.Job = job_model
+        self.User = user_model
+        self.replica = replica
+        self.executor = executor
+        self.batch_size = batch_size
+        # A running job whose heartbeat is older than this is presumed dead and may be taken over
+        self.lease = lease
+        self.on_catalog_change = on_catalog_change
+
+    def start(self, user):
+        """Queue deletion of ``user`` (reusing an unfinished job) and run it in the background."""
+        job = self.db.session.execute(
+            select(self.Job).where(self.Job.user_id == user.id, self.Job.status != 'done')
+        ).scalar()
+        if job is None:
+            job = self.Job(user_id=user.id, farmer=user.name, status='pending', done=0,
+                           created_at=int(time.time()), heartbeat=0)
+            self.db.session.add(job)
+            self.db.session.commit()
+        self._spawn(job.id)
+        return job
+
+    def resume(self):
+        """Restart every job left pending or running by a previous process."""
+        unfinished = self.db.session.scalars(
+            select(self.Job.id).where(self.Job.status.in_(('pending', 'running')))
+        ).all()
+        for job_id in unfinished:
+            self._spawn(job_id)
+        return len(unfinished)
+
+    def _spawn(self, job_id):
+        threading.Thread(target=self._run, args=(job_id,), name=f"deletion-job-{job_id}", daemon=True).start()
+
+    def _claim(self, job_id):
+        # Atomically take the job unless another live worker already holds it
+        now = int(time.time())
+        result = self.db.session.execute(
+            update(self.Job)
+            .where(self.Job.id == job_id,
+                   or_(self.Job.status.in_(('pending', 'failed')),
+                       (self.Job.status == 'running') & (self.Job.heartbeat < now - self.lease)))
+            .values(status='running', heartbeat=now, error=None)
+        )
+        self.db.session.commit()
+        return result.rowcount == 1
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            if not self._claim(job_id):
+                return
+            job = self.db.session.get(self.Job, job_id)
+            try:
+                self._deactivate_products(job)
+                user = self.db.session.get(self.User, job.user_id)
+                if user is not None:
+                    self.db.session.delete(user)
+                job.status = 'done'
+                self.db.session.commit()
+            except Exception as e:
+                self.db.session.rollback()
+                job = self.db.session.get(self.Job, job_id)
+                job.status = 'failed'
+                job.error = str(e)
+                self.db.session.commit()
+                logger.exception("Deletion job %s failed", job_id)
+
+    def _deactivate_products(self, job):
+        # Ask Stripe, not the replica: it may not have been synced yet, or may be missing products
+        # made in the Dashboard. After a restart only the products still active are listed
+        remaining = [product['id'] for product in
+                     iter_products(active=True, farmer=job.farmer, executor=self.executor)]
+        if job.total is None:
+            job.total = len(remaining)
+            self.db.session.commit()
+
+        for start in range(0, len(remaining), self.batch_size):
+            batch = remaining[start:start + self.batch_size]
+            self.replica.record_products(self._deactivate_batch(batch))
+            job.done = min(job.total, job.done + len(batch))
+            job.heartbeat = int(time.time())
+            self.db.session.commit()
+            if self.on_catalog_change is not None:
+                self.on_catalog_change()
+
+    def _deactivate_batch(self, product_ids, attempts=5):
+        # Deactivating twice is harmless, so a batch that hit Stripe's rate limit is simply resent
+        for attempt in range(attempts):
+            try:
+                return self.executor.map(lambda product_id: stripe.Product.modify(product_id, active=False),
+                                         product_ids)
+            except stripe.error.RateLimitError:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(2 ** attempt)
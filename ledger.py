@@ -0,0 +1,162 @@
+"""Local ledger of orders, with daily sales per farmer and per product kept up to date.
+
+Orders used to exist only as Stripe Checkout Sessions, so a sales report
+would have had to page through Stripe on every view. Now
+``create_checkout_session`` records each order and its lines as ``open``
+right after the session is created. The success page and the
+``checkout.session.completed`` webhook then mark it ``paid``; an order the
+ledger never saw created gets its lines from Stripe at that point.
+
+The transition to ``paid`` is one conditional UPDATE, so whichever of
+success page and webhook gets there first adds the order to the daily
+totals: units and revenue per product and per farmer, plus the number of
+orders, all keyed by the UTC day of payment. Reports then read a handful of
+indexed rows instead of summing order lines. Amounts are in the smallest
+currency unit.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+
+
+def day_of(timestamp):
+    """The UTC day of a Unix ``timestamp``, as ``YYYY-MM-DD``."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+class OrderLedger:
+    def __init__(self, db, order_model, line_model, farmer_day_model, product_day_model):
+        self.db = db
+        self.Order = order_model
+        self.Line = line_model
+        self.FarmerDay = farmer_day_model
+        self.ProductDay = product_day_model
+
+    def record(self, session_id, lines, buyer_email=None, currency=None, created_at=None):
+        """Record a new, unpaid order.
+
+        ``lines`` are dicts with product_id, price_id, name, farmer, quantity
+        and unit_amount. Recording the same session twice does nothing.
+        """
+        session = self.db.session
+        try:
+            self._add_order(session_id, lines, buyer_email, currency, created_at)
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+
+    def confirm(self, session_id, load_lines, buyer_email=None, paid_at=None):
+        """Mark an order paid and add it to the daily totals, once; returns its lines.
+
+        ``load_lines`` is called for the lines of an order that was never
+        recorded (made before the ledger existed, say) and returns them as
+        :meth:`record` takes them.
+        """
+        session = self.db.session
+        paid_at = int(time.time()) if paid_at is None else paid_at
+        for attempt in range(2):
+            try:
+                lines = self.lines(session_id)
+                if not lines:
+                    self._add_order(session_id, load_lines(), buyer_email, None, paid_at)
+                    session.flush()
+                    lines = self.lines(session_id)
+                paid = session.execute(
+                    update(self.Order).where(self.Order.session_id == session_id, self.Order.status == 'open')
+                    .values(status='paid', paid_at=paid_at).execution_options(synchronize_session=False)
+                ).rowcount
+                if paid:
+                    self._add_to_totals(lines, day_of(paid_at))
+                session.commit()
+                return lines
+            except IntegrityError:
+                # A concurrent request recorded the order or started a day's totals first; go again on top of it
+                session.rollback()
+                if attempt:
+                    raise
+
+    def lines(self, session_id):
+        """The lines of an order, as rows (not model instances, so they outlive the transaction)."""
+        Line = self.Line
+        return self.db.session.execute(
+            select(Line.product_id, Line.name, Line.farmer, Line.quantity, Line.unit_amount)
+            .where(Line.session_id == session_id)
+        ).all()
+
+    def _add_order(self, session_id, lines, buyer_email, currency, created_at):
+        session = self.db.session
+        session.add(self.Order(
+            session_id=session_id,
+            status='open',
+            buyer_email=buyer_email,
+            currency=currency,
+            total=sum(line['unit_amount'] * line['quantity'] for line in lines),
+            created_at=int(time.time()) if created_at is None else created_at,
+        ))
+        for line in lines:
+            session.add(self.Line(session_id=session_id, **line))
+
+    def _add_to_totals(self, lines, day):
+        farmers = {}
+        for line in lines:
+            revenue = line.unit_amount * line.quantity
+            self._add(self.ProductDay, {'product_id': line.product_id, 'day': day},
+                      {'farmer': line.farmer, 'name': line.name},
+                      orders=1, units=line.quantity, revenue=revenue)
+            units, total = farmers.get(line.farmer, (0, 0))
+            farmers[line.farmer] = (units + line.quantity, total + revenue)
+        for farmer, (units, revenue) in farmers.items():
+            self._add(self.FarmerDay, {'farmer': farmer, 'day': day}, {}, orders=1, units=units, revenue=revenue)
+
+    def _add(self, model, key, values, **amounts):
+        # Add to a day's row, starting it if this is the day's first sale
+        session = self.db.session
+        changed = session.execute(
+            update(model).filter_by(**key)
+            .values(**values, **{name: getattr(model, name) + amount for name, amount in amounts.items()})
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not changed:
+            session.add(model(**key, **values, **amounts))
+            session.flush()
+
+    def _since(self, days):
+        return (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+
+    def farmer_report(self, farmer, days=30):
+        """One farmer's sales over the last ``days`` days: totals, per day and per product."""
+        since = self._since(days)
+        session = self.db.session
+        daily = session.execute(
+            select(self.FarmerDay.day, self.FarmerDay.orders, self.FarmerDay.units, self.FarmerDay.revenue)
+            .where(self.FarmerDay.farmer == farmer, self.FarmerDay.day >= since)
+            .order_by(self.FarmerDay.day.desc())
+        ).all()
+        products = session.execute(
+            select(self.ProductDay.product_id, func.max(self.ProductDay.name).label('name'),
+                   func.sum(self.ProductDay.orders).label('orders'), func.sum(self.ProductDay.units).label('units'),
+                   func.sum(self.ProductDay.revenue).label('revenue'))
+            .where(self.ProductDay.farmer == farmer, self.ProductDay.day >= since)
+            .group_by(self.ProductDay.product_id)
+            .order_by(func.sum(self.ProductDay.revenue).desc())
+        ).all()
+        return {
+            'days': days,
+            'orders': sum(row.orders for row in daily),
+            'units': sum(row.units for row in daily),
+            'revenue': sum(row.revenue for row in daily),
+            'daily': daily,
+            'products': products,
+        }
+
+    def farmers_report(self, days=30):
+        """Every farmer's sales over the last ``days`` days, best-selling first."""
+        return self.db.session.execute(
+            select(self.FarmerDay.farmer, func.sum(self.FarmerDay.orders).label('orders'),
+                   func.sum(self.FarmerDay.units).label('units'), func.sum(self.FarmerDay.revenue).label('revenue'))
+            .where(self.FarmerDay.day >= self._since(days))
+            .group_by(self.FarmerDay.farmer)
+            .order_by(func.sum(self.FarmerDay.revenue).desc())
+        ).all()
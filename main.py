@@ -1,37 +1,109 @@
-from flask import Flask, redirect, render_template, jsonify, request, session, flash, url_for
+from flask import Flask, abort, g, redirect, render_template, jsonify, request, flash, send_file, url_for
 import stripe
 from forms import RegisterForm, LoginForm, AddProductForm
 from email_validator import validate_email, EmailNotValidError
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String
+from sqlalchemy import Boolean, Index, Integer, String, Text
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.http import is_resource_modified
+from datetime import datetime, timezone
+import hmac
 import os
+import random
+import threading
+import time
+import click
 from flask_bootstrap import Bootstrap
-import smtplib
+from catalog import CatalogCache, LazyRows, LoadTimeout, keyset_page, offset_page, paginate
+from search import SearchIndex
+from stripe_io import StripeExecutor
+from replica import CATALOG_EVENTS, CatalogReplica
+from webhooks import signature_header
+from notifications import NotificationQueue, build_digests
+from jobs import FarmerDeletionJobs
+from carts import CartStore
+from ledger import OrderLedger
+from streaming import PageCache, stream_page
+from database import create_indexes, engine_options, tune_sqlite, widen_columns
+from identity import Identity, IdentityCache
+from passwords import HasherBusy, PasswordHasher
+from breaker import CircuitBreaker, CircuitOpen
+from snapshot import SnapshotStore
+from metrics import Metrics
+from profiler import ProfileStore, Sampler
 
 stripe.api_key = os.getenv('SECRET KEY')
+# Point the SDK at a local stand-in such as benchmarks/fake_stripe.py
+if os.environ.get('STRIPE_API_BASE'):
+    stripe.api_base = os.environ['STRIPE_API_BASE']
 DOMAIN = 'http://localhost:5001'
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'SECRET KEY'
+
+# Each request to Stripe gives up after STRIPE_TIMEOUT seconds (the SDK's own default is 80)
+app.config['STRIPE_TIMEOUT'] = float(os.environ.get('STRIPE_TIMEOUT', 10))
+
+# After STRIPE_BREAKER_FAILURES failed or slower-than-STRIPE_BREAKER_SLOW_CALL calls in a row, stop calling Stripe for
+# STRIPE_BREAKER_RESET seconds, doubling up to STRIPE_BREAKER_RESET_MAX while trial calls keep failing
+app.config['STRIPE_BREAKER_FAILURES'] = int(os.environ.get('STRIPE_BREAKER_FAILURES', 5))
+app.config['STRIPE_BREAKER_SLOW_CALL'] = float(os.environ.get('STRIPE_BREAKER_SLOW_CALL', 3))
+app.config['STRIPE_BREAKER_RESET'] = float(os.environ.get('STRIPE_BREAKER_RESET', 5))
+app.config['STRIPE_BREAKER_RESET_MAX'] = float(os.environ.get('STRIPE_BREAKER_RESET_MAX', 300))
+stripe_breaker = CircuitBreaker(
+    'Stripe',
+    failure_threshold=app.config['STRIPE_BREAKER_FAILURES'],
+    slow_call=app.config['STRIPE_BREAKER_SLOW_CALL'],
+    reset_timeout=app.config['STRIPE_BREAKER_RESET'],
+    max_reset_timeout=app.config['STRIPE_BREAKER_RESET_MAX'],
+    # Outages, 5xx answers and rate limiting; a bad request is not Stripe's fault
+    failure_types=(stripe.APIConnectionError, stripe.APIError, stripe.RateLimitError),
+)
+
+# Shared pool for Stripe requests: at most STRIPE_MAX_CONCURRENCY in flight, STRIPE_RATE_LIMIT per second
+app.config['STRIPE_MAX_CONCURRENCY'] = int(os.environ.get('STRIPE_MAX_CONCURRENCY', 8))
+app.config['STRIPE_RATE_LIMIT'] = float(os.environ.get('STRIPE_RATE_LIMIT', 25))
+stripe_executor = StripeExecutor(max_workers=app.config['STRIPE_MAX_CONCURRENCY'],
+                                 rate=app.config['STRIPE_RATE_LIMIT'], breaker=stripe_breaker)
+
+stripe.default_http_client = stripe.new_default_http_client(timeout=app.config['STRIPE_TIMEOUT'])
+
+# How long a checkout view waits for Stripe in all, retries included, before answering 503
+app.config['CHECKOUT_LATENCY_BUDGET'] = float(os.environ.get('CHECKOUT_LATENCY_BUDGET', 15))
+
+
+def stripe_call(method, *args, budget=None, **kwargs):
+    # Call a Stripe SDK method such as stripe.checkout.Session.retrieve through the shared rate limit and breaker,
+    # giving up with TimeoutError after `budget` seconds (each attempt is bounded by STRIPE_TIMEOUT as well)
+    if budget is None:
+        return stripe_executor.call(method, *args, **kwargs)
+    return stripe_executor.call_within(budget, method, *args, **kwargs)
+
+
 bootstrap = Bootstrap(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-@login_manager.user_loader
-def load_user(user_id):
-    return db.get_or_404(Perdoruesit, user_id)
-
-
 # ------------------------------------------------DATABASE--------------------------------------------------------------
 class Base(DeclarativeBase):
     pass
 
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_URI', 'sqlite:///perdoruesit.db')
+# Connection pool and SQLite settings (see database.py)
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'], pool_size=app.config['DB_POOL_SIZE'],
+    max_overflow=app.config['DB_MAX_OVERFLOW'], pool_timeout=app.config['DB_POOL_TIMEOUT'],
+    pool_recycle=app.config['DB_POOL_RECYCLE'], busy_timeout=app.config['SQLITE_BUSY_TIMEOUT'],
+)
 db = SQLAlchemy(model_class=Base)
 db.init_app(app)
 
@@ -41,15 +113,318 @@ class Perdoruesit(db.Model, UserMixin):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
+    # Room for the longer scrypt hashes and salts PASSWORD_HASH_METHOD may select
+    password: Mapped[str] = mapped_column(String(255))
     role: Mapped[str] = mapped_column(String(250), nullable=False)
 
+    # name and email are already indexed through their unique constraints
+    __table_args__ = (
+        Index('ix_Perdoruesit_role_id', 'role', 'id'),
+    )
+
+
+# Local replica of the Stripe catalog (see replica.py)
+class Product(db.Model):
+    __tablename__ = "Product"
+    id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    name: Mapped[str] = mapped_column(String(250), nullable=False)
+    description: Mapped[str] = mapped_column(Text, nullable=True)
+    image: Mapped[str] = mapped_column(String(2048), nullable=True)
+    category: Mapped[str] = mapped_column(String(250), index=True)
+    farmer: Mapped[str] = mapped_column(String(250), index=True)
+    active: Mapped[bool] = mapped_column(Boolean, default=True, index=True)
+    created: Mapped[int] = mapped_column(Integer, default=0)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (
+        Index('ix_Product_active_category', 'active', 'category'),
+        Index('ix_Product_active_farmer', 'active', 'farmer'),
+    )
+
+
+class Price(db.Model):
+    __tablename__ = "Price"
+    id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    product_id: Mapped[str] = mapped_column(String(255), index=True)
+    unit_amount: Mapped[int] = mapped_column(Integer, nullable=False)
+    currency: Mapped[str] = mapped_column(String(10), nullable=True)
+    active: Mapped[bool] = mapped_column(Boolean, default=True, index=True)
+    created: Mapped[int] = mapped_column(Integer, default=0)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class CatalogSync(db.Model):
+    __tablename__ = "CatalogSync"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    cursor: Mapped[int] = mapped_column(Integer, default=0)
+    # Bumped with every product or price change written to the replica
+    version: Mapped[int] = mapped_column(Integer, default=0)
+    changed_at: Mapped[int] = mapped_column(Integer, default=0)
+
+
+# Stripe webhook events that have already been handled
+class StripeEvent(db.Model):
+    __tablename__ = "StripeEvent"
+    id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    type: Mapped[str] = mapped_column(String(100), nullable=False)
+    created: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+# Paid Checkout Sessions whose farmer notifications have been queued
+class OrderNotification(db.Model):
+    __tablename__ = "OrderNotification"
+    session_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    queued_at: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+# Orders, recorded when their Checkout Session is created and marked paid once Stripe says so (see ledger.py)
+class Order(db.Model):
+    __tablename__ = "Order"
+    session_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    status: Mapped[str] = mapped_column(String(20), index=True)
+    buyer_email: Mapped[str] = mapped_column(String(250), nullable=True)
+    currency: Mapped[str] = mapped_column(String(10), nullable=True)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[int] = mapped_column(Integer, index=True)
+    paid_at: Mapped[int] = mapped_column(Integer, nullable=True)
+
+
+class OrderLine(db.Model):
+    __tablename__ = "OrderLine"
+    session_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    product_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    price_id: Mapped[str] = mapped_column(String(255), nullable=True)
+    name: Mapped[str] = mapped_column(String(250))
+    farmer: Mapped[str] = mapped_column(String(250), index=True)
+    quantity: Mapped[int] = mapped_column(Integer)
+    unit_amount: Mapped[int] = mapped_column(Integer)
+
+
+# Paid orders added up per farmer and per product for each day, as they are paid
+class FarmerSalesDay(db.Model):
+    __tablename__ = "FarmerSalesDay"
+    farmer: Mapped[str] = mapped_column(String(250), primary_key=True)
+    day: Mapped[str] = mapped_column(String(10), primary_key=True, index=True)
+    orders: Mapped[int] = mapped_column(Integer, default=0)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class ProductSalesDay(db.Model):
+    __tablename__ = "ProductSalesDay"
+    product_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    day: Mapped[str] = mapped_column(String(10), primary_key=True)
+    farmer: Mapped[str] = mapped_column(String(250))
+    name: Mapped[str] = mapped_column(String(250))
+    orders: Mapped[int] = mapped_column(Integer, default=0)
+    units: Mapped[int] = mapped_column(Integer, default=0)
+    revenue: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (
+        Index('ix_ProductSalesDay_farmer_day', 'farmer', 'day'),
+    )
+
+
+# Background deletion of a farmer account and their products (see jobs.py)
+class DeletionJob(db.Model):
+    __tablename__ = "DeletionJob"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, index=True)
+    farmer: Mapped[str] = mapped_column(String(250), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), index=True)
+    total: Mapped[int] = mapped_column(Integer, nullable=True)
+    done: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+    created_at: Mapped[int] = mapped_column(Integer)
+    heartbeat: Mapped[int] = mapped_column(Integer, default=0)
+
+
+# Server-side carts (see carts.py); amounts are in the smallest currency unit
+class Cart(db.Model):
+    __tablename__ = "Cart"
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    count: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[int] = mapped_column(Integer, index=True)
+
+
+class CartLine(db.Model):
+    __tablename__ = "CartLine"
+    cart_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    product_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    price_id: Mapped[str] = mapped_column(String(255))
+    quantity: Mapped[int] = mapped_column(Integer)
+    unit_amount: Mapped[int] = mapped_column(Integer)
+
 
 with app.app_context():
+    tune_sqlite(db.engine, busy_timeout=app.config['SQLITE_BUSY_TIMEOUT'])
     db.create_all()
+    create_indexes(db)
+    widen_columns(db)
+
+
+# -----------------------------------------------MONITORING-------------------------------------------------------------
+# METRICS_ENABLED=1 times every Stripe request, SQL statement, template and email (see metrics.py): each response gets
+# a Server-Timing header, and /metrics serves per-route histograms in the Prometheus text format. Off by default, and
+# then none of the timing hooks is installed.
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '0') == '1'
+# Lets a scraper read /metrics with "Authorization: Bearer <token>"; admins can always read it
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+request_metrics = None
+if app.config['METRICS_ENABLED']:
+    request_metrics = Metrics()
+    request_metrics.instrument_stripe(stripe.default_http_client)
+    with app.app_context():
+        request_metrics.instrument_engine(db.engine)
+    request_metrics.instrument_templates(app)
+
+
+@app.before_request
+def start_timing():
+    if request_metrics is not None:
+        g.timings = request_metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.pop('timings', None)
+    if timings is None:
+        return response
+    response.headers['Server-Timing'] = timings.server_timing()
+    # Counted in the histograms once the body has been sent, so streamed pages are timed in full
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method, status = request.method, response.status_code
+    response.call_on_close(lambda: request_metrics.finish_request(timings, route, method, status))
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    is_admin = current_user.is_authenticated and current_user.role == 'admin'
+    has_token = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if request_metrics is None or not (is_admin or has_token):
+        abort(404)
+    return request_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# Sampling profiler (see profiler.py): an admin adds ?_profile=1 (or the header "X-Profile: 1") to any URL to profile
+# that request, and PROFILE_SAMPLE_RATE of all other requests (e.g. 0.001) are profiled at random. The newest
+# PROFILE_KEEP profiles are kept in PROFILE_DIR as flame graph input and listed on /profiles.
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50))
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_MAX_SECONDS'] = float(os.environ.get('PROFILE_MAX_SECONDS', 30))
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+profiles = ProfileStore(app.config['PROFILE_DIR'], keep=app.config['PROFILE_KEEP'])
+
+
+def profile_trigger():
+    # Why this request should be profiled, or None
+    if request.args.get('_profile') == '1' or request.headers.get('X-Profile') == '1':
+        if current_user.is_authenticated and current_user.role == 'admin':
+            return 'admin'
+    if app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        return 'random'
+    return None
+
+
+@app.before_request
+def start_profile():
+    trigger = profile_trigger()
+    if trigger is not None:
+        g.profile = (trigger, Sampler(threading.get_ident(), interval=app.config['PROFILE_INTERVAL'],
+                                      max_seconds=app.config['PROFILE_MAX_SECONDS']).start())
+
+
+@app.after_request
+def save_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    trigger, sampler = profile
+    name = profiles.new_name()
+    info = {'trigger': trigger, 'method': request.method, 'path': request.full_path.rstrip('?'),
+            'status': response.status_code}
+
+    def finish():
+        # Once the body has been sent, so a streamed page is profiled in full
+        sampler.stop()
+        try:
+            profiles.save(name, sampler, **info)
+        except OSError:
+            app.logger.exception("Could not save profile %s", name)
+
+    response.call_on_close(finish)
+    if trigger == 'admin':
+        response.headers['X-Profile'] = url_for('download_profile', name=name)
+    return response
+
+
+@app.route('/profiles')
+def list_profiles():
+    if not current_user.is_authenticated or current_user.role != 'admin':
+        abort(404)
+    recent = profiles.list()
+    for profile in recent:
+        profile['created'] = datetime.fromtimestamp(profile['created_at'])
+    return render_template('profiles.html', profiles=recent, keep=app.config['PROFILE_KEEP'],
+                           sample_rate=app.config['PROFILE_SAMPLE_RATE'])
+
+
+@app.route('/profiles/<name>')
+def download_profile(name):
+    if not current_user.is_authenticated or current_user.role != 'admin':
+        abort(404)
+    path = profiles.path(name)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='text/plain', as_attachment=True, download_name=f'{name}.folded')
 
 
 # ----------------------------------------------USER HANDLING-----------------------------------------------------------
+# Logged-in users are looked up in a cache instead of the database on every request (see identity.py)
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 300))
+app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', 10000))
+
+
+def find_identity(user_id):
+    row = db.session.execute(
+        db.select(Perdoruesit.id, Perdoruesit.name, Perdoruesit.email, Perdoruesit.role)
+        .where(Perdoruesit.id == user_id)
+    ).first()
+    return Identity(*row) if row else None
+
+
+identity_cache = IdentityCache(find_identity, ttl=app.config['IDENTITY_CACHE_TTL'],
+                               max_entries=app.config['IDENTITY_CACHE_SIZE'])
+# Registrations, role changes and deletions drop the user's cached identity when they commit
+identity_cache.watch(db.session, Perdoruesit)
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        abort(404)
+    return identity
+
+
+# Passwords are hashed on a pool of worker processes, off the request threads (see passwords.py).
+# Hashes made with other settings are upgraded the next time their user logs in.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 32))
+# Started here, before any background thread exists, because the pool forks its workers
+password_hasher = PasswordHasher(method=app.config['PASSWORD_HASH_METHOD'],
+                                 salt_length=app.config['PASSWORD_SALT_LENGTH'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 max_pending=app.config['PASSWORD_HASH_QUEUE']).start()
+
+
 @app.route('/create-admin')
 def create_admin():
     # Prevent re-creation if user already exists
@@ -65,7 +440,7 @@ def create_admin():
     if existing_user:
         return "Admin user already exists."
 
-    hashed_password = generate_password_hash(input_password, method='pbkdf2:sha256', salt_length=8)
+    hashed_password = password_hasher.hash(input_password)
     new_user = Perdoruesit(
         email=input_email,
         password=hashed_password,
@@ -91,11 +466,7 @@ def register():
                 flash("You've already signed up with that email, log in instead!")
                 return redirect(url_for("login"))
 
-            hash_salted_password = generate_password_hash(
-                form.password.data,
-                method='pbkdf2:sha256',
-                salt_length=8
-            )
+            hash_salted_password = password_hasher.hash(form.password.data)
             new_user = Perdoruesit(
                 email=form.email.data,
                 password=hash_salted_password,
@@ -109,6 +480,9 @@ def register():
         except EmailNotValidError as e:
             flash(str(e), "error")
             return redirect(url_for("register"))
+        except HasherBusy:
+            flash("Serveri është i zënë, ju lutem provoni përsëri.")
+            return redirect(url_for("register"))
     return render_template("register.html", form=form, current_user=current_user)
 
 
@@ -123,12 +497,24 @@ def login():
         if not user:
             flash("This email does not exist, please try again or go to the register page.")
             return redirect(url_for("login"))
-        elif not check_password_hash(user.password, password):
-            flash("Incorrect password, please try again.")
+        try:
+            if not password_hasher.verify(user.password, password):
+                flash("Incorrect password, please try again.")
+                return redirect(url_for("login"))
+            # Upgrade a hash made with older settings while the plain password is at hand
+            if password_hasher.needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                try:
+                    db.session.commit()
+                except SQLAlchemyError:
+                    # Keep the old hash (it still verifies) rather than fail the login
+                    db.session.rollback()
+                    app.logger.exception("Could not upgrade the password hash of user %s", user.id)
+        except HasherBusy:
+            flash("Serveri është i zënë, ju lutem provoni përsëri.")
             return redirect(url_for("login"))
-        else:
-            login_user(user)
-            return redirect(url_for("home"))
+        login_user(user)
+        return redirect(url_for("home"))
     return render_template("login.html", form=form, current_user=current_user)
 
 
@@ -139,52 +525,261 @@ def logout():
 
 
 # ------------------------------------------FUNCTIONS REGARDING PRODUCTS------------------------------------------------
+app.config['CATALOG_CACHE_TTL'] = int(os.environ.get('CATALOG_CACHE_TTL', 60))
+app.config['CATALOG_CACHE_SIZE'] = int(os.environ.get('CATALOG_CACHE_SIZE', 32))
+app.config['CATALOG_CACHE_STALE_TTL'] = int(os.environ.get('CATALOG_CACHE_STALE_TTL', 300))
+catalog_cache = CatalogCache(ttl=app.config['CATALOG_CACHE_TTL'], max_entries=app.config['CATALOG_CACHE_SIZE'],
+                             stale_ttl=app.config['CATALOG_CACHE_STALE_TTL'])
+replica = CatalogReplica(db, Product, Price, CatalogSync, executor=stripe_executor)
+search_index = SearchIndex()
+# Under several worker processes set a snapshot path (e.g. instance/catalog.snapshot): one worker at a time
+# then refreshes the catalog and publishes it to that file, and every worker serves the newest file from
+# shared memory (see snapshot.py). Unset, each worker syncs and holds its own copy.
+app.config['CATALOG_SNAPSHOT_PATH'] = os.environ.get('CATALOG_SNAPSHOT_PATH')
+app.config['CATALOG_SNAPSHOT_CHECK'] = float(os.environ.get('CATALOG_SNAPSHOT_CHECK', 1))
+
+
+def index_snapshot(snapshot):
+    # The request that maps a new snapshot holds the store's lock, so only the very first snapshot
+    # is indexed there (search would find nothing otherwise); later ones on a background thread
+    if len(search_index):
+        search_index.sync_later(snapshot.ordered)
+    else:
+        search_index.sync(snapshot.ordered)
+
+
+def search_rows(catalog, query, limit=None):
+    # The index only holds product ids; one the served catalog does not have (yet) is skipped
+    found = (catalog.rows.get(product_id) for product_id in search_index.search(query, limit=limit))
+    return [row for row in found if row is not None]
+
+
+catalog_snapshots = None
+if app.config['CATALOG_SNAPSHOT_PATH']:
+    catalog_snapshots = SnapshotStore(app.config['CATALOG_SNAPSHOT_PATH'],
+                                      check_interval=app.config['CATALOG_SNAPSHOT_CHECK'],
+                                      on_swap=index_snapshot)
+app.config['SEARCH_RESULT_LIMIT'] = int(os.environ.get('SEARCH_RESULT_LIMIT', 60))
+# Products per page on the category pages and /api/products; later pages are loaded as the user scrolls
+app.config['CATALOG_PAGE_SIZE'] = int(os.environ.get('CATALOG_PAGE_SIZE', 24))
+app.config['CATALOG_PAGE_SIZE_MAX'] = int(os.environ.get('CATALOG_PAGE_SIZE_MAX', 100))
+API_FIELDS = ('id', 'name', 'description', 'image', 'price', 'category', 'farmer', 'price_id')
+# Listing pages are streamed to the browser in chunks of about this many characters
+app.config['STREAM_CHUNK_SIZE'] = int(os.environ.get('STREAM_CHUNK_SIZE', 8192))
+
+
+def stream_listing(template_name, **context):
+    return stream_page(app, template_name, chunk_size=app.config['STREAM_CHUNK_SIZE'], **context)
+
+
+# Rendered category pages, one per (page, role); they are re-rendered when the catalog version changes
+app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 64))
+page_cache = PageCache(max_entries=app.config['PAGE_CACHE_SIZE'])
+
+
+def category_page(template_name, category):
+    # A category page looks the same for everyone with the same role
+    role = current_user.role if current_user.is_authenticated else 'anonymous'
+    limit = app.config['CATALOG_PAGE_SIZE']
+    catalog = catalog_cache.peek('catalog') and get_catalog()
+    if catalog is None:
+        # Nothing loaded yet: stream the page so the header goes out while the catalog loads
+        products_data = LazyRows(lambda: get_catalog().category(category), limit=limit)
+        return stream_listing(template_name, products=products_data, category=category, current_user=current_user)
+
+    # Repeat visits revalidate and get a 304 until the catalog changes, without rendering anything
+    etag = f"{catalog.version}-{category}-{role}"
+    last_modified = datetime.fromtimestamp(catalog.changed_at, timezone.utc) if catalog.changed_at else None
+    key = (template_name, role)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+    else:
+        page = page_cache.get(key, catalog.version)
+        if page is not None:
+            response = app.response_class(page, mimetype='text/html')
+        else:
+            products_data = LazyRows(lambda: catalog.category(category), limit=limit)
+            response = stream_listing(template_name, products=products_data, category=category,
+                                      current_user=current_user,
+                                      on_complete=lambda html: page_cache.put(key, catalog.version, html))
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+app.config['STRIPE_WEBHOOK_SECRET'] = os.environ.get('STRIPE_WEBHOOK_SECRET')
+# With webhooks, how often to pull Stripe's events anyway, for deliveries that never arrived (seconds)
+app.config['CATALOG_RECONCILE_INTERVAL'] = int(os.environ.get('CATALOG_RECONCILE_INTERVAL', 3600))
+
+
+def index_replica(stale=False):
+    # Stale entries are refreshed on a background thread, so bring our own app context
+    with app.app_context():
+        catalog = replica.load_index(stale=stale)
+    # Re-index only the products that changed since the previous snapshot; with
+    # snapshots the index follows the snapshot being served instead (index_snapshot)
+    if catalog_snapshots is None or catalog_snapshots.current() is None:
+        search_index.sync(catalog.rows.values())
+    return catalog
+
+
+def sync_catalog():
+    # With webhooks configured Stripe pushes every change to /stripe-webhook, so the
+    # replica is usually current; it still needs a first full sync, and now and then
+    # the events since the last sync to catch deliveries that failed. Without webhooks
+    # pull only the changes since the last sync, every time
+    if app.config['STRIPE_WEBHOOK_SECRET']:
+        with app.app_context():
+            due = replica.sync_due(app.config['CATALOG_RECONCILE_INTERVAL'])
+        if not due:
+            return index_replica()
+    try:
+        with app.app_context():
+            replica.sync()
+    except CircuitOpen:
+        return index_replica(stale=True)
+    except Exception:
+        # Serve the catalog as last synced; the next load tries Stripe again
+        app.logger.exception("Catalog sync failed, serving the last synced catalog")
+        return index_replica(stale=True)
+    return index_replica()
+
+
+def publish_catalog():
+    snapshot = catalog_snapshots.current()
+    if snapshot is None or catalog_snapshots.age() >= app.config['CATALOG_CACHE_TTL']:
+        catalog_snapshots.publish(sync_catalog())
+        return
+    # Another worker synced a moment ago; publish again only if a product was changed since
+    with app.app_context():
+        changed = replica.version() != snapshot.version
+    if changed:
+        catalog_snapshots.publish(index_replica())
+
+
+def load_catalog():
+    if catalog_snapshots is None:
+        return sync_catalog()
+    # Only one worker refreshes at a time; the others keep serving what was published last
+    with catalog_snapshots.refreshing() as refresher:
+        if refresher:
+            publish_catalog()
+    snapshot = catalog_snapshots.current()
+    if snapshot is None:
+        return index_replica(stale=True)
+    if not refresher:
+        with app.app_context():
+            behind = replica.version() != snapshot.version
+        if behind:
+            # A change written after the refreshing worker looked (a farmer's edit made here, say) would
+            # otherwise be cached until the TTL runs out: wait for that worker and publish the change
+            with catalog_snapshots.refreshing(wait=True):
+                publish_catalog()
+            snapshot = catalog_snapshots.current()
+    return snapshot
+
+
+@app.cli.command('sync-catalog')
+@click.option('--full', is_flag=True, help='Re-download the whole catalog instead of applying recent changes.')
+def sync_catalog_command(full):
+    """Synchronise the local catalog replica with Stripe."""
+    count = replica.full_sync() if full else replica.sync()
+    click.echo(f"Synced {count} catalog objects.")
+
+
+@app.cli.command('replay-webhook')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def replay_webhook_command(paths):
+    """Sign recorded event payloads and post them to /stripe-webhook."""
+    secret = app.config['STRIPE_WEBHOOK_SECRET']
+    if not secret:
+        raise click.UsageError("Set STRIPE_WEBHOOK_SECRET to sign the payloads.")
+    client = app.test_client()
+    for path in paths:
+        with open(path, 'rb') as f:
+            payload = f.read()
+        response = client.post('/stripe-webhook', data=payload,
+                               headers={'Stripe-Signature': signature_header(payload, secret)})
+        click.echo(f"{path}: {response.status_code} {response.get_data(as_text=True).strip()}")
+
+
+@app.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    if not app.config['STRIPE_WEBHOOK_SECRET']:
+        return jsonify({'error': 'Webhook secret is not configured'}), 404
+    payload = request.get_data()
+    try:
+        event = stripe.Webhook.construct_event(
+            payload, request.headers.get('Stripe-Signature', ''), app.config['STRIPE_WEBHOOK_SECRET']
+        )
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return jsonify({'error': 'Invalid payload or signature'}), 400
+
+    # Stripe retries deliveries, so the same event can arrive more than once
+    if db.session.get(StripeEvent, event['id']):
+        return jsonify({'status': 'duplicate'})
+
+    applied = False
+    if event['type'] in CATALOG_EVENTS:
+        applied = replica.apply_event(event)
+    elif event['type'] == 'checkout.session.completed':
+        confirm_order(event['data']['object'])
+    db.session.add(StripeEvent(id=event['id'], type=event['type'], created=event['created']))
+    db.session.commit()
+    if applied:
+        catalog_cache.invalidate()
+    return jsonify({'status': 'applied' if applied else 'ignored'})
+
+
+# How long a catalog page waits for a refresh from Stripe before serving the catalog as last synced
+app.config['CATALOG_LATENCY_BUDGET'] = float(os.environ.get('CATALOG_LATENCY_BUDGET', 1))
+
+
+def get_catalog():
+    # Serve the indexed catalog from the cache, hitting Stripe only after the TTL expires
+    try:
+        catalog = catalog_cache.get('catalog', load_catalog, timeout=app.config['CATALOG_LATENCY_BUDGET'])
+    except LoadTimeout:
+        # Stripe is slow: answer from the replica now and let the refresh finish in the background
+        catalog = catalog_snapshots and catalog_snapshots.current()
+        if catalog is None:
+            catalog = catalog_cache.get('catalog-stale', lambda: index_replica(stale=True))
+        g.catalog_stale = True
+    else:
+        if catalog_snapshots is not None:
+            # Serve the newest snapshot whichever worker published it, not only the one loaded here
+            snapshot = catalog_snapshots.current()
+            catalog = catalog if snapshot is None else snapshot
+    if catalog.stale:
+        g.catalog_stale = True
+    return catalog
+
+
+@app.after_request
+def flag_stale_catalog(response):
+    # Tell clients (and monitoring) when a page was built from a catalog that could not be synced
+    if g.get('catalog_stale'):
+        response.headers['X-Catalog-Stale'] = '1'
+    return response
+
 
 @app.route('/produktet-e-tua', methods=["GET", "POST"])
 def produktet_fermer():
     try:
-        # Fetch products and prices from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        products_data = []
-
-        # Filter products by category
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-                # Get all prices for this product
-            product_prices = [p for p in prices['data'] if p['product'] == product['id']]
-
-            if not product_prices:
-                continue
-
-            # Sort prices by creation date (newest first)
-            latest_price = sorted(product_prices, key=lambda p: p['created'], reverse=True)[0]
-
-            # Check if product belongs to current farmer
-            if product['metadata'].get('Fermeri', '') == current_user.name:
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': latest_price['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized'),
-                    'price_id': latest_price['id']
-                })
-
         if request.method == 'POST':
             action = request.form.get('action')
             product_id = request.form.get('product_id')
 
             if action == 'delete':
-                stripe.Product.modify(product_id, active=False)
+                replica.record_product(stripe.Product.modify(product_id, active=False))
+                catalog_cache.invalidate()
                 return redirect('/produktet-e-tua')
 
             if action == 'edit':
                 new_price = request.form.get('new_price')
-                price_id = request.form.get('price_id')
 
                 # Create a new price object with the updated price
                 new_price = float(new_price) * 100  # Convert to cents
@@ -193,14 +788,15 @@ def produktet_fermer():
                     unit_amount=int(new_price),
                     currency="ALL"
                 )
-
-                for product in products_data:
-                    if product['id'] == product_id:
-                        product['price'] = new_price / 100
+                replica.record_price(new_price_obj)
+                catalog_cache.invalidate()
 
                 return redirect('/produktet-e-tua')
 
-        return render_template('produkte-fermer.html', products=products_data, current_user=current_user)
+        # Products of the current farmer, fetched (cached) while the page header is already on its way
+        products_data = LazyRows(lambda: get_catalog().farmer(current_user.name))
+        sales = order_ledger.farmer_report(current_user.name, app.config['SALES_REPORT_DAYS'])
+        return stream_listing('produkte-fermer.html', products=products_data, sales=sales, current_user=current_user)
 
     except Exception as e:
         return f"Error: {str(e)}"
@@ -224,11 +820,14 @@ def add_product():
             )
 
             # Create a price for the product
-            stripe.Price.create(
+            price = stripe.Price.create(
                 product=product.id,
                 unit_amount=form.price.data * 100,  # Stripe expects cents
                 currency="ALL"
             )
+            replica.record_product(product)
+            replica.record_price(price)
+            catalog_cache.invalidate()
 
             flash("Produkti u shtua me sukses në Stripe!", "success")
             return redirect(url_for('produktet_fermer'))
@@ -242,126 +841,140 @@ def add_product():
 @app.route('/kerko', methods=['GET', 'POST'])
 def search_by_name():
     try:
-        search_query = request.args.get('q', '').lower()
-
-        # Fetch products and prices from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-
-            # Filter by search query if present
-            if search_query and search_query not in product['name'].lower():
-                continue
-
-            # Find price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data:
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('index.html', products=products_data, current_user=current_user, search_query=search_query)
+        search_query = request.args.get('q', '')
+        limit = request.args.get('limit', app.config['SEARCH_RESULT_LIMIT'], type=int)
+        limit = max(1, min(limit, app.config['CATALOG_PAGE_SIZE_MAX']))
+
+        # Fetch products and prices (cached); this also keeps the search index current
+        catalog = get_catalog()
+
+        # Ranked matches on name, description and category; without a query list the catalog.
+        # One extra match tells whether there is a next page for the browser to load.
+        if search_query.strip():
+            products_data, next_cursor = offset_page(search_rows(catalog, search_query, limit=limit + 1), limit=limit)
+        else:
+            products_data, next_cursor = keyset_page(catalog.ordered, limit=limit)
+
+        return render_template('index.html', products=products_data, next_cursor=next_cursor,
+                               current_user=current_user, search_query=search_query)
     except Exception as e:
         return f"Error: {str(e)}"
 
 
+@app.route('/api/products')
+def api_products():
+    category = request.args.get('category')
+    farmer = request.args.get('farmer')
+    search_query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', app.config['CATALOG_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['CATALOG_PAGE_SIZE_MAX']))
+
+    # Only send the fields the caller asked for
+    fields = [field for field in request.args.get('fields', '').split(',') if field] or list(API_FIELDS)
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    catalog = get_catalog()
+    if search_query:
+        # Search results keep their relevance order, so they are paged by position
+        rows = [row for row in search_rows(catalog, search_query)
+                if (not category or row['category'] == category) and (not farmer or row['farmer'] == farmer)]
+        page = offset_page
+    else:
+        if category and farmer:
+            rows = [row for row in catalog.category(category) if row['farmer'] == farmer]
+        elif category:
+            rows = catalog.category(category)
+        elif farmer:
+            rows = catalog.farmer(farmer)
+        else:
+            rows = catalog.ordered
+        page = keyset_page
+    try:
+        products_data, next_cursor = page(rows, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = jsonify({
+        'data': [{field: row[field] for field in fields} for row in products_data],
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None,
+        'stale': catalog.stale,
+    })
+    # Let browsers revalidate with If-None-Match and get a 304 while the catalog is unchanged
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
 # ----------------------------------------------ADMIN FUNCTIONS---------------------------------------------------------
+app.config['DELETION_BATCH_SIZE'] = int(os.environ.get('DELETION_BATCH_SIZE', 20))
+app.config['USERS_PAGE_SIZE'] = int(os.environ.get('USERS_PAGE_SIZE', 50))
+deletion_jobs = FarmerDeletionJobs(app, db, DeletionJob, Perdoruesit, replica, stripe_executor,
+                                   batch_size=app.config['DELETION_BATCH_SIZE'],
+                                   on_catalog_change=catalog_cache.invalidate)
+
+with app.app_context():
+    deletion_jobs.resume()
+
+
 @app.route('/perdoruesit')
 def perdoruesit():
-    result = db.session.execute(db.select(Perdoruesit))
-    all_users = result.scalars().all()
-    return render_template("perdoruesit.html", users=all_users, current_user=current_user)
+    # One page of users at a time, continuing after the last id shown (optionally one role only)
+    role = request.args.get('role')
+    after = request.args.get('after', 0, type=int)
+    query = db.select(Perdoruesit).where(Perdoruesit.id > after)
+    if role:
+        query = query.where(Perdoruesit.role == role)
+    query = query.order_by(Perdoruesit.id).limit(app.config['USERS_PAGE_SIZE'] + 1)
+    users = db.session.execute(query).scalars().all()
+    next_after = None
+    if len(users) > app.config['USERS_PAGE_SIZE']:
+        users = users[:app.config['USERS_PAGE_SIZE']]
+        next_after = users[-1].id
+
+    # Farmer deletions still in progress, shown with a progress bar
+    jobs = {job.user_id: job for job in db.session.execute(
+        db.select(DeletionJob).where(DeletionJob.status != 'done',
+                                     DeletionJob.user_id.in_([user.id for user in users]))
+    ).scalars()}
+    return render_template("perdoruesit.html", users=users, jobs=jobs, role=role, after=after,
+                           next_after=next_after, current_user=current_user)
 
 
 @app.route('/fshi-llogarine/<int:id>')
 def fshi_llogarine(id):
     user_to_delete = db.get_or_404(Perdoruesit, id)
     if user_to_delete.role == 'Fermer':
-        try:
-            # Fetch products and prices from Stripe
-            products = stripe.Product.list()
-            prices = stripe.Price.list()
-
-            products_data = []
-
-            # Filter products by category
-            for product in products['data']:
-                if not product.get('active', True):
-                    continue
-                    # Get all prices for this product
-                product_prices = [p for p in prices['data'] if p['product'] == product['id']]
-
-                if not product_prices:
-                    continue
-
-                # Sort prices by creation date (newest first)
-                latest_price = sorted(product_prices, key=lambda p: p['created'], reverse=True)[0]
-
-                # Check if product belongs to current farmer
-                if product['metadata'].get('Fermeri', '') == user_to_delete.name:
-                    products_data.append({
-                        'id': product['id'],
-                        'name': product['name'],
-                        'description': product['description'],
-                        'image': product['images'][0] if product['images'] else None,
-                        'price': latest_price['unit_amount'] / 100,
-                        'category': product['metadata'].get('Category', 'Uncategorized'),
-                        'price_id': latest_price['id']
-                    })
-                    stripe.Product.modify(product.id, active=False)
-        except Exception as e:
-            return f"Error: {str(e)}"
+        # Deactivating a farmer's products can take a while, so it runs as a background job
+        deletion_jobs.start(user_to_delete)
+        return redirect(url_for('perdoruesit'))
     db.session.delete(user_to_delete)
     db.session.commit()
     return redirect(url_for('perdoruesit'))
 
 
+@app.route('/cache-stats')
+def cache_stats():
+    if not current_user.is_authenticated or current_user.role != 'admin':
+        abort(404)
+    return jsonify(catalog=catalog_cache.stats(), pages=page_cache.stats(), identities=identity_cache.stats(),
+                   stripe=stripe_breaker.stats(), snapshot=catalog_snapshots and catalog_snapshots.stats())
+
+
+@app.route('/fshi-llogarine/progres/<int:job_id>')
+def fshi_llogarine_progres(job_id):
+    job = db.get_or_404(DeletionJob, job_id)
+    return jsonify(status=job.status, total=job.total, done=job.done, error=job.error)
+
+
 @app.route('/shiko-produktet/<string:name>')
 def shiko_produktet(name):
-    try:
-        # Fetch products and prices from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        products_data = []
-
-        # Filter products by category
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-                # Get all prices for this product
-            product_prices = [p for p in prices['data'] if p['product'] == product['id']]
-
-            if not product_prices:
-                continue
-
-            # Sort prices by creation date (newest first)
-            latest_price = sorted(product_prices, key=lambda p: p['created'], reverse=True)[0]
-
-            # Check if product belongs to current farmer
-            if product['metadata'].get('Fermeri', '') == name:
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': latest_price['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized'),
-                    'price_id': latest_price['id']
-                })
-
-    except Exception as e:
-        return f"Error: {str(e)}"
-    return render_template("produktet-admin.html", products=products_data, farmer=name)
+    # Fetch products and prices (cached) once the page header has been sent
+    products_data = LazyRows(lambda: get_catalog().farmer(name))
+    sales = order_ledger.farmer_report(name, app.config['SALES_REPORT_DAYS'])
+    return stream_listing("produktet-admin.html", products=products_data, sales=sales, farmer=name)
 
 
 # ----------------------------------------------WEB MAIN PAGES----------------------------------------------------------
@@ -372,228 +985,106 @@ def home():
 
 @app.route('/produkte_bulmeti')
 def produkte_bulmeti():
-    try:
-        # Fetch products from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        # Filter products by category
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-            # Find the price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data and product['metadata'].get('Category', '') == 'Bulmet':
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('produkte-bulmeti.html', products=products_data, current_user=current_user)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return category_page('produkte-bulmeti.html', 'Bulmet')
 
 
 @app.route('/produkte_shtazore')
 def produkte_shtazore():
-    try:
-        # Fetch products from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        # Filter products by category
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-            # Find the price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data and product['metadata'].get('Category', '') == 'Shtazore':
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('produkte-shtazore.html', products=products_data, current_user=current_user)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return category_page('produkte-shtazore.html', 'Shtazore')
 
 
 @app.route('/fruta')
 def fruta():
-    try:
-        # Fetch products from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        # Filter products by category
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-            # Find the price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data and product['metadata'].get('Category', '') == 'Fruta':
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('fruta.html', products=products_data, current_user=current_user)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return category_page('fruta.html', 'Fruta')
 
 
 @app.route('/perime')
 def perime():
-    try:
-        # Fetch products from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        # Filter products by category
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-            # Find the price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data and product['metadata'].get('Category', '') == 'Perime':
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('perime.html', products=products_data, current_user=current_user)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return category_page('perime.html', 'Perime')
 
 
 @app.route('/pije')
 def pije():
-    try:
-        # Fetch products from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        # Filter products by category
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-            # Find the price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data and product['metadata'].get('Category', '') == 'Pije':
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('pije.html', products=products_data, current_user=current_user)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return category_page('pije.html', 'Pije')
 
 
 @app.route('/tjera')
 def tjera():
-    try:
-        # Fetch products from Stripe
-        products = stripe.Product.list()
-        prices = stripe.Price.list()
-
-        # Filter products by category
-        products_data = []
-        for product in products['data']:
-            if not product.get('active', True):
-                continue
-            # Find the price for this product
-            price_data = next((price for price in prices['data'] if price['product'] == product['id']), None)
-            if price_data and product['metadata'].get('Category', '') == 'Tjera':
-                products_data.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'description': product['description'],
-                    'image': product['images'][0] if product['images'] else None,
-                    'price': price_data['unit_amount'] / 100,
-                    'category': product['metadata'].get('Category', 'Uncategorized')
-                })
-
-        return render_template('tjera.html', products=products_data, current_user=current_user)
-    except Exception as e:
-        return f"Error: {str(e)}"
+    return category_page('tjera.html', 'Tjera')
 
 # -------------------------------------------------CART-----------------------------------------------------------------
+app.config['CART_TTL'] = int(os.environ.get('CART_TTL', 7 * 24 * 3600))
+app.config['CART_CACHE_SIZE'] = int(os.environ.get('CART_CACHE_SIZE', 1024))
+cart_store = CartStore(app, db, Cart, CartLine, max_cached=app.config['CART_CACHE_SIZE'], ttl=app.config['CART_TTL'])
+
+
+def current_cart():
+    return cart_store.get(request.cookies.get('cart_id'))
+
+
+def cart_view(cart):
+    # Lines as the cart templates expect them, named from the catalog
+    catalog = get_catalog()
+    items = {}
+    for product_id, line in cart.lines.items():
+        product = catalog.get(product_id)
+        if product is not None:
+            name = product['name']
+        else:
+            # No longer for sale; the replica still knows its name
+            name = getattr(db.session.get(Product, product_id), 'name', product_id)
+        price = line['unit_amount'] / 100
+        items[product_id] = {
+            'name': name,
+            'price': price,
+            'quantity': line['quantity'],
+            'total_price': price * line['quantity'],
+        }
+    return items
+
+
 @app.route('/add-to-cart', methods=['POST'])
 def add_to_cart():
-    # Get product details from the form
+    # Get product details from the form; name and price come from the catalog, not the page
     product_id = request.form.get('product_id')
-    product_name = request.form.get('name')
-    product_price = float(request.form.get('price'))
-    quantity = int(request.form.get('quantity', 1))
+    quantity = request.form.get('quantity', 1, type=int)
+    if quantity < 1:
+        flash("Sasia duhet të jetë të paktën 1.")
+        return redirect('/cart')
+    product = get_catalog().get(product_id)
+    if product is None:
+        flash("Ky produkt nuk është më në dispozicion.")
+        return redirect('/cart')
 
-    # Initialize cart if not already in session
-    if 'cart' not in session:
-        session['cart'] = {}
+    # Create the cart on first use
+    cart = current_cart()
+    new_cart = cart is None
+    if new_cart:
+        cart = cart_store.create()
 
-    cart = session['cart']
+    cart_store.add(cart, product_id, product['price_id'], round(product['price'] * 100), quantity)
 
-    # If the product is already in the cart, update the quantity and total
-    if product_id in cart:
-        cart[product_id]['quantity'] += quantity
-        cart[product_id]['total_price'] = cart[product_id]['quantity'] * product_price
-    else:
-        # Add new product to the cart
-        cart[product_id] = {
-            'name': product_name,
-            'price': product_price,
-            'quantity': quantity,
-            'total_price': quantity * product_price,
-        }
-
-    # Save cart back to session
-    session['cart'] = cart
-    return redirect('/cart')  # Redirect to the cart page
+    response = redirect('/cart')  # Redirect to the cart page
+    if new_cart:
+        response.set_cookie('cart_id', cart.id, max_age=app.config['CART_TTL'], httponly=True, samesite='Lax')
+    return response
 
 
 @app.route('/cart')
 def cart():
-    cart = session.get('cart', {})
-    total_price = sum(item['total_price'] for item in cart.values())
-    return render_template('cart.html', cart=cart, total_price=total_price)
+    cart = current_cart()
+    if cart is None:
+        return render_template('cart.html', cart={}, total_price=0)
+    return render_template('cart.html', cart=cart_view(cart), total_price=cart.total / 100)
 
 
 @app.route('/remove-from-cart', methods=['POST'])
 def remove_from_cart():
     product_id = request.form.get('product_id')
 
-    # Check if the cart exists in the session
-    if 'cart' in session and product_id in session['cart']:
-        # Remove the product from the cart
-        session['cart'].pop(product_id, None)
-
-        # Save changes back to the session
-        session.modified = True  # Ensure the session updates
+    cart = current_cart()
+    if cart is not None:
+        cart_store.remove(cart, product_id)
 
     return redirect('/cart')  # Redirect back to the cart page
 
@@ -601,98 +1092,224 @@ def remove_from_cart():
 # -------------------------------------------------STRIPE---------------------------------------------------------------
 @app.route('/checkout')
 def checkout():
-    cart = session.get('cart', {})
-    if not cart:
+    cart = current_cart()
+    if cart is None or not cart.lines:
         return redirect('/cart')  # Redirect back to cart if it's empty
-    total_price = sum(item['total_price'] for item in cart.values())
-    return render_template('checkout.html', cart=cart, total_price=total_price)
+    return render_template('checkout.html', cart=cart_view(cart), total_price=cart.total / 100)
 
 
-def get_stripe_price_id(product_name):
-    # Fetch all products from Stripe
-    products = stripe.Product.list()
+def resolve_cart(cart):
+    # Resolve every cart line against the cached catalog in one pass
+    catalog = get_catalog()
+    items = []
+    for product_id, item in cart.lines.items():
+        product = catalog.get(product_id)
+        if product is None:
+            raise LookupError(f'Price ID not found for {product_id}')
+        # A price_id posted from an older page is never trusted; charge the product's current price
+        items.append({'product': product, 'price_id': product['price_id'], 'quantity': item['quantity']})
+    return items
 
-    # Find the product by name
-    for product in products['data']:
-        if product['name'] == product_name:
-            # Fetch prices for the product
-            prices = stripe.Price.list(product=product['id'])
-            # Return the first Price ID (or match based on your logic)
-            if prices['data']:
-                return prices['data'][0]['id']
 
-    return None
+# Errors that mean Stripe cannot be reached right now, rather than that the request was wrong
+STRIPE_UNAVAILABLE = (CircuitOpen, TimeoutError, stripe.APIConnectionError)
+
+
+def stripe_unavailable():
+    # Stripe is down or over budget: answer at once and tell the client when to come back
+    response = jsonify({'error': 'Payments are temporarily unavailable, please try again shortly.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(stripe_breaker.retry_after()) + 1)
+    return response
 
 
 @app.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():
     try:
-        # Fetch the cart from the session
-        cart = session.get('cart', {})
+        cart = current_cart()
+        if cart is None or not cart.lines:
+            return jsonify({'error': 'Cart is empty'}), 400
+
+        try:
+            items = resolve_cart(cart)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 400
 
         # Create line items for Stripe Checkout
-        line_items = []
-        for item in cart.values():
-            price_id = get_stripe_price_id(item['name'])
-            if not price_id:
-                return jsonify({'error': f'Price ID not found for {item["name"]}'}), 400
-
-            line_items.append({
-                'price': price_id,
-                'quantity': item['quantity'],
-            })
-
-            # Get farmer's name
-            price_data = stripe.Price.retrieve(price_id)
-            product_id = price_data['product']
-            product_data = stripe.Product.retrieve(product_id)
-            farmer = product_data['metadata'].get('Fermeri', 'Uncategorized')
-
-            farmer_email = db.session.query(Perdoruesit).filter(Perdoruesit.name == farmer).first().email
-
-            with smtplib.SMTP("smtp.gmail.com", port=587) as connection:
-                connection.starttls()
-                connection.login(user="admin@gmail.com", password="12345678")
-                connection.sendmail(
-                    from_addr="admin@gmail.com",
-                    to_addrs=farmer_email,
-                    msg=f"Subject: Kërkesë: Porosi e re!\n\nPërshëndetje {farmer}! Përgatisni porosinë e mëposhtme:\n{item['quantity']} {product_data['name']}\n për adresën {current_user.email}"
-                )
+        line_items = [{'price': item['price_id'], 'quantity': item['quantity']} for item in items]
 
-        # Create Stripe Checkout Session
-        stripe_session = stripe.checkout.Session.create(
+        # Create Stripe Checkout Session; farmers are notified once it has been paid
+        stripe_session = stripe_call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=line_items,
             mode='payment',
-            success_url=DOMAIN + '/success',
+            success_url=DOMAIN + '/success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url=DOMAIN + '/cancel',
+            metadata={'buyer_email': current_user.email} if current_user.is_authenticated else {},
+            budget=app.config['CHECKOUT_LATENCY_BUDGET'],
         )
 
+        try:
+            order_ledger.record(stripe_session.id, [order_line(item) for item in items],
+                                buyer_email=current_user.email if current_user.is_authenticated else None,
+                                currency=stripe_session.get('currency'))
+        except Exception:
+            # The order is still confirmed from Stripe's copy once it is paid
+            app.logger.exception("Could not record order %s", stripe_session.id)
+
         return jsonify({'url': stripe_session.url})
 
+    except STRIPE_UNAVAILABLE:
+        return stripe_unavailable()
     except Exception as e:
         # Log the error for debugging
         print(f"Error creating Checkout Session: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+# ---------------------------------------------------ORDERS-------------------------------------------------------------
+# Orders and daily sales per farmer and product are kept in the local database (see ledger.py); the sales pages show
+# the last SALES_REPORT_DAYS days
+app.config['SALES_REPORT_DAYS'] = int(os.environ.get('SALES_REPORT_DAYS', 30))
+order_ledger = OrderLedger(db, Order, OrderLine, FarmerSalesDay, ProductSalesDay)
+
+
+def order_line(item):
+    # A resolved cart item (see resolve_cart) as a line of the order ledger
+    product = item['product']
+    return {'product_id': product['id'], 'price_id': item['price_id'], 'name': product['name'],
+            'farmer': product['farmer'], 'quantity': item['quantity'], 'unit_amount': round(product['price'] * 100)}
+
+
+def order_lines_from_stripe(session_id):
+    # The lines of an order the ledger never saw created, from Stripe, with names and farmers from the replica
+    line_items = list(paginate(stripe.checkout.Session.list_line_items, {'session': session_id, 'limit': 100},
+                               stripe_executor))
+    products = {product.id: product for product in db.session.execute(
+        db.select(Product).where(Product.id.in_([line['price']['product'] for line in line_items]))
+    ).scalars()}
+    lines = {}
+    for line in line_items:
+        product_id = line['price']['product']
+        if product_id in lines:
+            lines[product_id]['quantity'] += line['quantity']
+            continue
+        product = products.get(product_id)
+        lines[product_id] = {
+            'product_id': product_id,
+            'price_id': line['price']['id'],
+            'name': product.name if product else line.get('description') or product_id,
+            'farmer': product.farmer if product else '',
+            'quantity': line['quantity'],
+            'unit_amount': line['price']['unit_amount'] or 0,
+        }
+    return list(lines.values())
+
+
+def buyer_email_of(stripe_session):
+    metadata = stripe_session.get('metadata') or {}
+    customer_details = stripe_session.get('customer_details') or {}
+    return metadata.get('buyer_email') or customer_details.get('email')
+
+
+def confirm_order(stripe_session):
+    # A paid order: count it in the sales totals and notify its farmers, once (success page and webhook both land here)
+    if stripe_session['payment_status'] != 'paid':
+        return
+    session_id = stripe_session['id']
+    lines = order_ledger.confirm(session_id, lambda: order_lines_from_stripe(session_id),
+                                 buyer_email=buyer_email_of(stripe_session))
+    quantities = {line.product_id: line.quantity for line in lines}
+    notify_farmers(stripe_session, quantities)
+
+
+@app.route('/shitjet')
+def shitjet():
+    if not current_user.is_authenticated or current_user.role != 'admin':
+        abort(404)
+    days = app.config['SALES_REPORT_DAYS']
+    return render_template('shitjet.html', farmers=order_ledger.farmers_report(days), days=days)
+
+
+# -------------------------------------------------NOTIFICATIONS--------------------------------------------------------
+app.config['SMTP_HOST'] = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+app.config['SMTP_PORT'] = int(os.environ.get('SMTP_PORT', 587))
+app.config['SMTP_USER'] = os.environ.get('SMTP_USER', 'admin@gmail.com')
+app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD', '12345678')
+app.config['SMTP_STARTTLS'] = os.environ.get('SMTP_STARTTLS', '1') == '1'
+app.config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER', 'admin@gmail.com')
+app.config['NOTIFICATION_WORKERS'] = int(os.environ.get('NOTIFICATION_WORKERS', 2))
+
+notifications = NotificationQueue(
+    host=app.config['SMTP_HOST'],
+    port=app.config['SMTP_PORT'],
+    sender=app.config['MAIL_SENDER'],
+    username=app.config['SMTP_USER'],
+    password=app.config['SMTP_PASSWORD'],
+    starttls=app.config['SMTP_STARTTLS'],
+    workers=app.config['NOTIFICATION_WORKERS'],
+    metrics=request_metrics,
+)
+
+
+def notify_farmers(stripe_session, quantities):
+    # Queue one digest per farmer for a paid order, once; `quantities` are units per product id
+    if db.session.get(OrderNotification, stripe_session['id']):
+        return
+
+    try:
+        db.session.add(OrderNotification(session_id=stripe_session['id'], queued_at=int(time.time())))
+        db.session.commit()
+    except IntegrityError:
+        # Queued by a concurrent request for the same session
+        db.session.rollback()
+        return
+
+    # Farmers and their emails for the whole order in one query
+    rows = db.session.execute(
+        db.select(Product.id, Product.name, Product.farmer, Perdoruesit.email)
+        .outerjoin(Perdoruesit, Perdoruesit.name == Product.farmer)
+        .where(Product.id.in_(quantities))
+    ).all()
+    lines = [{'farmer': row.farmer, 'farmer_email': row.email, 'name': row.name, 'quantity': quantities[row.id]}
+             for row in rows]
+
+    notifications.enqueue(build_digests(stripe_session['id'], buyer_email_of(stripe_session), lines))
+
+
 @app.route('/success', methods=['GET'])
 def success():
     session_id = request.args.get('session_id')
-    stripe_session = stripe.checkout.Session.retrieve(session_id)
+    try:
+        stripe_session = stripe_call(stripe.checkout.Session.retrieve, session_id,
+                                     budget=app.config['CHECKOUT_LATENCY_BUDGET'])
+    except STRIPE_UNAVAILABLE:
+        return stripe_unavailable()
+    try:
+        confirm_order(stripe_session)
+    except Exception:
+        # The checkout.session.completed webhook retries the confirmation
+        app.logger.exception("Could not confirm order %s", session_id)
 
     return render_template('success.html', session=stripe_session)
 
 
 @app.route('/session-status', methods=['GET'])
 def session_status():
-  session = stripe.checkout.Session.retrieve(request.args.get('session_id'))
+  try:
+    session = stripe_call(stripe.checkout.Session.retrieve, request.args.get('session_id'),
+                          budget=app.config['CHECKOUT_LATENCY_BUDGET'])
+  except STRIPE_UNAVAILABLE:
+    return stripe_unavailable()
   return jsonify(status=session.status, customer_email=session.customer_details.email)
 
 
 @app.route('/clear-cart', methods=['POST'])
 def clear_cart():
-    session.pop('cart', None)
+    cart = current_cart()
+    if cart is not None:
+        cart_store.clear(cart)
     return redirect('/')
 
 
@@ -0,0 +1,233 @@
+"""Timings of the slow parts of a request: Stripe calls, SQL queries, templates and SMTP sends.
+
+With ``METRICS_ENABLED=1`` every response carries a ``Server-Timing`` header
+saying where its time went (browsers show it in the developer tools, under
+the request's timing), e.g.::
+
+    Server-Timing: stripe;dur=212.4;desc="2 calls", db;dur=3.1;desc="4 queries", total;dur=219.6
+
+and the same timings are added up per route in histograms that ``/metrics``
+serves as Prometheus text. Unset, none of the hooks is installed and
+requests pay nothing for them.
+
+The timings of the request being served live in a context variable, so they
+follow it onto the Stripe executor's threads. Work done for no request
+(emails, background catalog syncs) only counts in the histogram of its own
+kind. A streamed page is still rendering when its header goes out, so its
+render time only reaches the histograms.
+"""
+import bisect
+import contextvars
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help, label names)
+FAMILIES = {
+    'merrbio_request_seconds': (
+        'histogram', 'Time to answer a request, streamed body included', ('route', 'method')),
+    'merrbio_request_component_seconds': (
+        'histogram', 'Time a request spent waiting on Stripe, the database, templates or SMTP', ('route', 'component')),
+    'merrbio_requests_total': (
+        'counter', 'Requests answered', ('route', 'method', 'status')),
+    'merrbio_stripe_request_seconds': (
+        'histogram', 'Stripe API requests, retries included', ('resource', 'method', 'status')),
+    'merrbio_db_query_seconds': (
+        'histogram', 'SQL statements', ('statement', 'table')),
+    'merrbio_template_render_seconds': (
+        'histogram', 'Templates rendered for a request', ('template',)),
+    'merrbio_smtp_send_seconds': (
+        'histogram', 'Emails handed to the SMTP server', ('outcome',)),
+}
+
+# Shown in the Server-Timing description: component -> (one, many)
+UNITS = {'stripe': ('call', 'calls'), 'db': ('query', 'queries'), 'render': ('template', 'templates'),
+         'smtp': ('email', 'emails')}
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+# Stripe resource names; any other path segment (prod_N1x2, cs_test_a1B2) is an object id
+_RESOURCE = re.compile(r'[a-z]+(?:_[a-z]+)*')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+["`\[]?(\w+)', re.IGNORECASE)
+
+
+def stripe_operation(method, url):
+    """The resource and operation of a Stripe API request.
+
+    ``GET /v1/checkout/sessions/cs_123/line_items`` is
+    ``('checkout.sessions.line_items', 'list')``, ``POST /v1/products/prod_1``
+    is ``('products', 'update')``.
+    """
+    segments = urlsplit(url).path.strip('/').split('/')[1:]
+    names = [segment for segment in segments if _RESOURCE.fullmatch(segment)]
+    by_id = bool(segments) and not _RESOURCE.fullmatch(segments[-1])
+    method = method.lower()
+    if method == 'get':
+        operation = 'retrieve' if by_id else 'list'
+    elif method == 'post':
+        operation = 'update' if by_id else 'create'
+    else:
+        operation = method
+    return '.'.join(names) or 'unknown', operation
+
+
+def sql_operation(statement):
+    """The statement type and first table of ``statement``, e.g. ``('SELECT', 'Perdoruesit')``."""
+    words = statement.lstrip().split(None, 1)
+    table = _TABLE.search(statement)
+    return words[0].upper() if words else '', table.group(1) if table else ''
+
+
+class RequestTimings:
+    """What one request has spent so far, as (component, seconds) pairs."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.rendering = []
+
+    def totals(self):
+        """{component: (count, seconds)}"""
+        totals = {}
+        for component, seconds in self.spans:
+            count, total = totals.get(component, (0, 0.0))
+            totals[component] = (count + 1, total + seconds)
+        return totals
+
+    def server_timing(self):
+        """The value of the ``Server-Timing`` header, in milliseconds."""
+        parts = []
+        for component, (count, seconds) in self.totals().items():
+            unit = UNITS.get(component)
+            description = f';desc="{count} {unit[count != 1]}"' if unit else ''
+            parts.append(f'{component};dur={seconds * 1000:.1f}{description}')
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+class Metrics:
+    """Histograms and counters in memory, rendered as Prometheus text by :meth:`render`."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        # (family, labels) -> counts per bucket, the +Inf bucket, then the sum
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, family, labels, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get((family, labels))
+            if histogram is None:
+                histogram = self._histograms[(family, labels)] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def increment(self, family, labels):
+        with self._lock:
+            self._counters[(family, labels)] = self._counters.get((family, labels), 0) + 1
+
+    def record(self, component, family, labels, seconds):
+        """Count ``seconds`` of ``component`` work towards the current request, if any, and ``family``."""
+        timings = _current.get()
+        if timings is not None:
+            timings.spans.append((component, seconds))
+        self.observe(family, labels, seconds)
+
+    def start_request(self):
+        timings = RequestTimings()
+        _current.set(timings)
+        return timings
+
+    def finish_request(self, timings, route, method, status):
+        """Add a request to the per-route histograms once its body has been sent."""
+        self.observe('merrbio_request_seconds', (route, method), time.perf_counter() - timings.started)
+        self.increment('merrbio_requests_total', (route, method, str(status)))
+        for component, (_, seconds) in timings.totals().items():
+            self.observe('merrbio_request_component_seconds', (route, component), seconds)
+        if _current.get() is timings:
+            _current.set(None)
+
+    def instrument_stripe(self, client):
+        """Time every request made through ``client``, a ``stripe.HTTPClient``."""
+        request = client.request_with_retries
+
+        def request_with_retries(method, url, *args, **kwargs):
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                response = request(method, url, *args, **kwargs)
+                status = str(response[1])
+                return response
+            finally:
+                self.record('stripe', 'merrbio_stripe_request_seconds', (*stripe_operation(method, url), status),
+                            time.perf_counter() - started)
+
+        client.request_with_retries = request_with_retries
+
+    def instrument_engine(self, engine):
+        """Time every statement ``engine`` executes."""
+        @event.listens_for(engine, 'before_cursor_execute')
+        def query_started(connection, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context.metrics_started = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def query_finished(connection, cursor, statement, parameters, context, executemany):
+            started = getattr(context, 'metrics_started', None)
+            if started is not None:
+                self.record('db', 'merrbio_db_query_seconds', sql_operation(statement), time.perf_counter() - started)
+
+    def instrument_templates(self, app):
+        """Time the templates ``app`` renders for requests (``render_template`` and streamed pages)."""
+        before_render_template.connect(self._render_started, app, weak=False)
+        template_rendered.connect(self._render_finished, app, weak=False)
+
+    def _render_started(self, sender, template, context, **extra):
+        timings = _current.get()
+        if timings is not None:
+            timings.rendering.append(time.perf_counter())
+
+    def _render_finished(self, sender, template, context, **extra):
+        timings = _current.get()
+        if timings is not None and timings.rendering:
+            self.record('render', 'merrbio_template_render_seconds', (template.name or 'string',),
+                        time.perf_counter() - timings.rendering.pop())
+
+    def render(self):
+        """Everything recorded so far in the Prometheus text format."""
+        with self._lock:
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+            counters = dict(self._counters)
+        series = {}
+        for (family, labels), value in (histograms | counters).items():
+            series.setdefault(family, []).append((labels, value))
+        lines = []
+        for family, (kind, description, label_names) in FAMILIES.items():
+            if family not in series:
+                continue
+            lines.append(f'# HELP {family} {description}')
+            lines.append(f'# TYPE {family} {kind}')
+            for labels, value in sorted(series[family]):
+                pairs = ','.join(f'{name}="{_escape(label)}"' for name, label in zip(label_names, labels))
+                if kind == 'counter':
+                    lines.append(f'{family}{{{pairs}}} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip((*self.buckets, '+Inf'), value[:-1]):
+                    cumulative += count
+                    lines.append(f'{family}_bucket{{{pairs},le="{bound}"}} {cumulative}')
+                lines.append(f'{family}_sum{{{pairs}}} {value[-1]:.6f}')
+                lines.append(f'{family}_count{{{pairs}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
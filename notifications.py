@@ -0,0 +1,149 @@
+"""Background delivery of order notifications to farmers.
+
+Checkout used to open a fresh SMTP connection per cart item inside the
+buyer's request. ``NotificationQueue`` hands the messages to a small pool of
+worker threads instead. Each worker keeps one SMTP connection open and reuses
+it. Failed sends are retried with exponential backoff.
+"""
+import logging
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+
+def build_digests(order_id, buyer_email, lines):
+    """Group an order's lines into one message per farmer.
+
+    ``lines`` are dicts with ``farmer``, ``farmer_email``, ``name`` and
+    ``quantity``. Lines whose farmer has no account (no email) are skipped.
+    """
+    by_farmer = {}
+    for line in lines:
+        if line['farmer_email']:
+            by_farmer.setdefault((line['farmer'], line['farmer_email']), []).append(line)
+
+    messages = []
+    for (farmer, email), farmer_lines in by_farmer.items():
+        items = "\n".join(f"{line['quantity']} {line['name']}" for line in farmer_lines)
+        message = EmailMessage()
+        message['Subject'] = "Kërkesë: Porosi e re!"
+        message['To'] = email
+        message.set_content(
+            f"Përshëndetje {farmer}! Përgatisni porosinë e mëposhtme:\n{items}\n"
+            f" për adresën {buyer_email}\n\nPorosia: {order_id}"
+        )
+        messages.append(message)
+    return messages
+
+
+class NotificationQueue:
+    """A bounded queue of emails drained by worker threads with persistent SMTP connections.
+
+    Workers start on the first :meth:`enqueue`. Set ``starttls=False`` and
+    leave ``username`` empty to deliver to a plain local SMTP server such as
+    aiosmtpd. Each attempt is timed into ``metrics`` (a metrics.Metrics),
+    if given.
+    """
+
+    def __init__(self, host, port, sender, username=None, password=None, starttls=True,
+                 workers=2, max_attempts=5, backoff=2.0, timeout=30, max_queued=1000, metrics=None):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.metrics = metrics
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._started = False
+        self._lock = threading.Lock()
+
+    def enqueue(self, messages):
+        self._start()
+        for message in messages:
+            if message['From'] is None:
+                message['From'] = self.sender
+            try:
+                self._queue.put_nowait((message, 1))
+            except queue.Full:
+                self.failed += 1
+                logger.error("Notification queue full, dropping message to %s", message['To'])
+
+    def join(self):
+        """Block until every queued message has been attempted once."""
+        self._queue.join()
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'sent': self.sent, 'retried': self.retried, 'failed': self.failed}
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"notifications-{i}", daemon=True).start()
+            self._started = True
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            connection.starttls()
+        if self.username:
+            connection.login(user=self.username, password=self.password)
+        return connection
+
+    def _send(self, connection, message):
+        try:
+            connection.send_message(message)
+            return connection
+        except smtplib.SMTPServerDisconnected:
+            # The server closed the idle connection; reconnect once and resend
+            connection = self._connect()
+            connection.send_message(message)
+            return connection
+
+    def _retry(self, message, attempt):
+        timer = threading.Timer(self.backoff * 2 ** (attempt - 1), self._queue.put, ((message, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+
+    def _work(self):
+        connection = None
+        while True:
+            message, attempt = self._queue.get()
+            started = time.perf_counter()
+            outcome = 'failed'
+            try:
+                if connection is None:
+                    connection = self._connect()
+                connection = self._send(connection, message)
+                self.sent += 1
+                outcome = 'sent'
+            except (smtplib.SMTPException, OSError) as e:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except OSError:
+                        pass
+                connection = None
+                if attempt >= self.max_attempts:
+                    self.failed += 1
+                    logger.error("Giving up on notification to %s: %s", message['To'], e)
+                else:
+                    self.retried += 1
+                    self._retry(message, attempt)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.record('smtp', 'merrbio_smtp_send_seconds', (outcome,), time.perf_counter() - started)
+                self._queue.task_done()
@@ -0,0 +1,85 @@
+"""Password hashing on a dedicated process pool.
+
+Hashing a password is deliberately slow CPU work. Done on the request
+thread, a burst of logins keeps every worker thread busy (and holding the
+GIL) while pages that only wait on Stripe queue up behind them.
+``PasswordHasher`` sends the work to a small pool of worker processes
+instead. A bounded number of hashes may be waiting or running at a time;
+past that, callers get :class:`HasherBusy` instead of piling up.
+
+The method and salt length are configurable. :meth:`PasswordHasher.needs_rehash`
+tells whether a stored hash was made with weaker settings, so the login
+view can replace it while it has the plain password at hand.
+
+The pool uses the ``fork`` start method and starts all of its workers in
+:meth:`PasswordHasher.start`. Call that at import time, before the app
+starts any background threads. Other start methods would re-import the
+application module in each worker.
+"""
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusy(RuntimeError):
+    """Raised when too many hashes are already waiting for the pool."""
+
+
+def _warm_up():
+    return True
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on ``workers`` processes (inline when ``workers`` is 0)."""
+
+    def __init__(self, method='pbkdf2:sha256:600000', salt_length=16, workers=2, max_pending=32, timeout=10):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        # The full method string werkzeug writes for these settings, e.g. 'pbkdf2:sha256:600000'
+        self._prefix = generate_password_hash('', method=method, salt_length=salt_length).split('$', 1)[0]
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+
+    def start(self):
+        """Fork the worker processes now (see the module docstring)."""
+        if self.workers and self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('fork'))
+            # With fork every worker is started on the first submit
+            self._pool.submit(_warm_up).result()
+        return self
+
+    def _run(self, fn, *args):
+        if self._pool is None:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HasherBusy("Too many password checks in progress")
+        try:
+            return self._pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A worker died; keep serving logins on the calling thread rather than failing them
+            logger.exception("Password hashing pool is broken, hashing inline")
+            self._pool = None
+            return fn(*args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, stored_hash, password):
+        return self._run(check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        """True if ``stored_hash`` was made with a different method or a shorter salt."""
+        method, _, rest = stored_hash.partition('$')
+        salt = rest.split('$', 1)[0]
+        return method != self._prefix or len(salt) < self.salt_length
@@ -0,0 +1,149 @@
+"""Sampling profiler for single requests, to see where a slow page spends its time in production.
+
+While a profiled request runs, a helper thread looks at the request thread's
+stack every ``interval`` seconds. The samples are saved in the collapsed
+stack format read by flamegraph.pl, speedscope and inferno: one line per
+distinct stack, frames from the outermost call inwards separated by
+semicolons, then the number of samples::
+
+    flask/app.py:Flask.wsgi_app;main.py:fruta;main.py:category_page 12
+
+:class:`ProfileStore` keeps only the newest profiles in its directory (a ring
+on disk), each with a small JSON file describing the request beside it.
+
+Only the request's own thread is sampled, so time spent on the Stripe
+executor shows up as the request thread waiting for it.
+"""
+import contextlib
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+_NAME = re.compile(r'\d{8}-\d{12}-\d+-\d+')
+
+
+def _where(filename):
+    # Paths relative to the app or to site-packages keep the frames short and the same on every machine
+    if filename.startswith(ROOT + os.sep):
+        return os.path.relpath(filename, ROOT)
+    _, separator, tail = filename.rpartition('-packages' + os.sep)
+    return tail if separator else os.path.join(*filename.split(os.sep)[-2:])
+
+
+class Sampler:
+    """Samples the stack of thread ``thread_id`` every ``interval`` seconds, for at most ``max_seconds``."""
+
+    def __init__(self, thread_id, interval=0.005, max_seconds=30):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.samples = Counter()
+        self.duration = None
+        self._labels = {}
+        self._started = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling; returns self."""
+        self._stopped.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return self
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            # Semicolons separate frames in the output
+            label = self._labels[code] = f'{_where(code.co_filename)}:{code.co_qualname}'.replace(';', ',')
+        return label
+
+    def _run(self):
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stopped.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.samples[';'.join(stack)] += 1
+
+    def collapsed(self):
+        """The samples as collapsed stacks, most frequent first."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+class ProfileStore:
+    """The newest ``keep`` profiles in ``directory``, shared by every worker process."""
+
+    def __init__(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        self._counter = itertools.count()
+
+    def new_name(self):
+        """A name for the next profile; names sort by the time they were made."""
+        now = time.time()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f'{int(now % 1 * 1e6):06d}'
+        return f'{stamp}-{os.getpid()}-{next(self._counter)}'
+
+    def save(self, name, sampler, **info):
+        """Write ``sampler``'s stacks and ``info`` under ``name``, then drop the oldest profiles beyond ``keep``."""
+        os.makedirs(self.directory, exist_ok=True)
+        info.update(name=name, samples=sum(sampler.samples.values()), duration_ms=round(sampler.duration * 1000, 1),
+                    interval_ms=sampler.interval * 1000, created_at=int(time.time()))
+        base = os.path.join(self.directory, name)
+        with open(base + '.folded.tmp', 'w', encoding='utf-8') as out:
+            out.write(sampler.collapsed())
+        os.replace(base + '.folded.tmp', base + '.folded')
+        # Written last: list() only shows profiles whose stacks are complete
+        with open(base + '.json.tmp', 'w', encoding='utf-8') as out:
+            json.dump(info, out)
+        os.replace(base + '.json.tmp', base + '.json')
+        self._prune()
+
+    def _names(self):
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((file[:-5] for file in files if file.endswith('.json') and _NAME.fullmatch(file[:-5])),
+                      reverse=True)
+
+    def _prune(self):
+        for name in self._names()[self.keep:]:
+            for suffix in ('.json', '.folded'):
+                # Another worker may be pruning the same profile
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, name + suffix))
+
+    def list(self):
+        """What is known about each stored profile, newest first."""
+        profiles = []
+        for name in self._names()[:self.keep]:
+            try:
+                with open(os.path.join(self.directory, name + '.json'), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        return profiles
+
+    def path(self, name):
+        """The collapsed stacks file of profile ``name``, or None if there is no such profile."""
+        if not _NAME.fullmatch(name):
+            return None
+        path = os.path.join(self.directory, name + '.folded')
+        return path if os.path.exists(path) else None
@@ -0,0 +1,247 @@
+"""Local copy of the Stripe catalog kept in the application database.
+
+``CatalogReplica`` mirrors Stripe products and prices into the ``Product`` and
+``Price`` tables so a worker can build its catalog index from an indexed
+local query instead of downloading everything from Stripe. After the first
+full sync, only the product/price events Stripe recorded since the last
+cursor are pulled and applied.
+"""
+import time
+
+import stripe
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.orm import aliased
+
+from catalog import STRIPE_PAGE_SIZE, CatalogIndex, iter_prices, iter_products, paginate
+
+CATALOG_EVENTS = [
+    'product.created', 'product.updated', 'product.deleted',
+    'price.created', 'price.updated', 'price.deleted',
+]
+
+# Stripe only keeps events for 30 days; an older cursor needs a full resync.
+EVENT_RETENTION = 30 * 24 * 3600
+
+
+class CatalogReplica:
+    """Synchronises the local ``Product``/``Price`` tables with Stripe."""
+
+    def __init__(self, db, product_model, price_model, state_model, executor=None):
+        self.db = db
+        self.executor = executor
+        self.Product = product_model
+        self.Price = price_model
+        self.State = state_model
+        # When this process last synced with Stripe (time.monotonic()); 0 if it never has
+        self.synced_at = 0
+
+    # ------------------------------------------------------------------ writes
+    def _state(self):
+        state = self.db.session.get(self.State, 1)
+        if state is None:
+            state = self.State(id=1, cursor=0, version=0, changed_at=0)
+            self.db.session.add(state)
+        return state
+
+    def _changed(self):
+        # Bump the catalog version in the same transaction as the change itself;
+        # rendered pages and ETags are keyed on it
+        state = self._state()
+        state.version = (state.version or 0) + 1
+        state.changed_at = int(time.time())
+
+    def _upsert(self, model, values, version):
+        # Keep the row unless it already reflects a newer change, so events
+        # that arrive late or twice cannot roll an object back
+        row = self.db.session.get(model, values['id'])
+        if row is None:
+            self.db.session.add(model(version=version, **values))
+            self._changed()
+            return True
+        if row.version is not None and row.version > version:
+            return False
+        if row.version == version and all(getattr(row, key) == value for key, value in values.items()):
+            return False
+        for key, value in values.items():
+            setattr(row, key, value)
+        row.version = version
+        self._changed()
+        return True
+
+    def _apply_product(self, product, version, deleted=False):
+        metadata = product.get('metadata') or {}
+        images = product.get('images') or []
+        return self._upsert(self.Product, {
+            'id': product['id'],
+            'name': product['name'],
+            'description': product.get('description'),
+            'image': images[0] if images else None,
+            'category': metadata.get('Category', 'Uncategorized'),
+            'farmer': metadata.get('Fermeri', ''),
+            'active': bool(product.get('active', True)) and not deleted,
+            'created': product.get('created', 0),
+        }, version)
+
+    def _apply_price(self, price, version, deleted=False):
+        product_id = price['product']
+        if not isinstance(product_id, str):
+            product_id = product_id['id']
+        return self._upsert(self.Price, {
+            'id': price['id'],
+            'product_id': product_id,
+            'unit_amount': price['unit_amount'],
+            'currency': price.get('currency'),
+            'active': bool(price.get('active', True)) and not deleted,
+            'created': price.get('created', 0),
+        }, version)
+
+    def record_product(self, product):
+        """Write a product the app just created or changed straight to the replica."""
+        self._apply_product(product, product_version(product))
+        self.db.session.commit()
+
+    def record_products(self, products):
+        """Write a batch of changed products in one transaction."""
+        for product in products:
+            self._apply_product(product, product_version(product))
+        self.db.session.commit()
+
+    def record_price(self, price):
+        """Write a price the app just created or changed straight to the replica."""
+        self._apply_price(price, price['created'])
+        self.db.session.commit()
+
+    # ------------------------------------------------------------------- sync
+    def full_sync(self):
+        """Replace the replica with a complete listing from Stripe.
+
+        Returns the number of products and prices written.
+        """
+        started = int(time.time())
+        session = self.db.session
+        # Load existing rows into the identity map so _upsert() does not query per row
+        session.scalars(select(self.Product)).all()
+        session.scalars(select(self.Price)).all()
+
+        # Both listings page concurrently on the shared Stripe pool
+        products = iter_products(active=None, executor=self.executor)
+        prices = iter_prices(active=None, executor=self.executor)
+        seen_products, seen_prices = set(), set()
+        try:
+            for product in products:
+                self._apply_product(product, product_version(product))
+                seen_products.add(product['id'])
+            for price in prices:
+                # Prices carry no last-change time, and price events are versioned with the event's time;
+                # a listing made after `started` is at least that new, so it overrides them
+                self._apply_price(price, started)
+                seen_prices.add(price['id'])
+        finally:
+            # If the products listing failed, the prices producer must not wait on its full queue forever
+            products.close()
+            prices.close()
+
+        # Anything Stripe no longer lists has been deleted
+        for model, seen in ((self.Product, seen_products), (self.Price, seen_prices)):
+            for row in session.scalars(select(model).where(model.active.is_(True))):
+                if row.id not in seen:
+                    row.active = False
+                    self._changed()
+
+        self._state().cursor = started
+        session.commit()
+        self.synced_at = time.monotonic()
+        return len(seen_products) + len(seen_prices)
+
+    def sync(self):
+        """Apply catalog events recorded by Stripe since the last cursor.
+
+        Falls back to :meth:`full_sync` when there is no cursor yet or it is
+        older than Stripe's event retention. Returns the number of objects
+        written.
+        """
+        state = self._state()
+        if not state.cursor or time.time() - state.cursor > EVENT_RETENTION:
+            return self.full_sync()
+
+        events = paginate(stripe.Event.list, {
+            'types': CATALOG_EVENTS,
+            'created': {'gte': state.cursor},
+            'limit': STRIPE_PAGE_SIZE,
+        }, self.executor)
+        # Stripe lists newest first; replay oldest first so later changes win
+        events = sorted(events, key=lambda event: event['created'])
+        for event in events:
+            self.apply_event(event)
+        if events:
+            state.cursor = events[-1]['created']
+        self.db.session.commit()
+        self.synced_at = time.monotonic()
+        return len(events)
+
+    def sync_due(self, interval):
+        """Whether the replica was never synced, or this process last synced over ``interval`` seconds ago."""
+        state = self.db.session.get(self.State, 1)
+        return not (state and state.cursor) or time.monotonic() - self.synced_at >= interval
+
+    def apply_event(self, event):
+        """Apply one product/price event; returns False if it changed nothing (e.g. it was out of date)."""
+        obj = event['data']['object']
+        deleted = event['type'].endswith('.deleted')
+        if event['type'].startswith('product.'):
+            return self._apply_product(obj, product_version(obj, event['created']), deleted=deleted)
+        if event['type'].startswith('price.'):
+            return self._apply_price(obj, event['created'], deleted=deleted)
+        return False
+
+    # ------------------------------------------------------------------- reads
+    def version(self):
+        """The catalog version stored next to the sync cursor (0 before the first change)."""
+        state = self.db.session.get(self.State, 1)
+        return state.version if state else 0
+
+    def load_index(self, stale=False):
+        """Build a CatalogIndex from active products joined to their latest active price.
+
+        Of two active prices created in the same second, the one with the
+        higher id counts as the latest, so every product appears once.
+        The index carries the catalog version and change time stored next to the sync cursor.
+        Pass ``stale=True`` when the replica could not be synced first.
+        """
+        Product, Price = self.Product, self.Price
+        newer = aliased(Price)
+        stmt = (
+            select(Product.id, Product.name, Product.description, Product.image,
+                   Price.unit_amount, Product.category, Product.farmer, Price.id.label('price_id'),
+                   Product.created)
+            .join(Price, and_(Price.product_id == Product.id, Price.active.is_(True)))
+            .where(Product.active.is_(True))
+            .where(~exists().where(newer.product_id == Price.product_id, newer.active.is_(True),
+                                   or_(newer.created > Price.created,
+                                       and_(newer.created == Price.created, newer.id > Price.id))))
+        )
+        state = self.db.session.get(self.State, 1)
+        return CatalogIndex((replica_row(row) for row in self.db.session.execute(stmt)),
+                            version=state.version if state else 0,
+                            changed_at=state.changed_at if state else 0,
+                            stale=stale)
+
+
+def product_version(product, default=0):
+    """Stripe's own last-change timestamp for a product, used to order writes."""
+    return product.get('updated') or product.get('created') or default
+
+
+def replica_row(row):
+    """The template dict for one row of :meth:`CatalogReplica.load_index`'s query."""
+    return {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'image': row.image,
+        'price': row.unit_amount / 100,
+        'category': row.category,
+        'farmer': row.farmer,
+        'price_id': row.price_id,
+        'created': row.created,
+    }
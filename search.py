@@ -0,0 +1,181 @@
+"""In-memory inverted index for product search.
+
+``SearchIndex`` maps every token of a product's name, description and
+category to the products that contain it. A query is answered from the
+postings of its tokens instead of scanning the catalog. The last query
+token also matches as a prefix, so results show up while the user is still
+typing. Text is folded to plain lowercase ASCII, so "djathe" finds "Djathë"
+and "kec" finds "Keç".
+
+The index keeps no copy of the catalog: per product only its postings, its
+name (to rank equal scores) and a digest of the indexed fields (to tell
+whether it changed). :meth:`SearchIndex.search` returns product ids, which
+the caller looks up in the catalog it is serving.
+"""
+import bisect
+import heapq
+import logging
+import re
+import threading
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# Score of a match in each field; a name match outranks a category match, etc.
+FIELD_WEIGHTS = {'name': 3.0, 'category': 2.0, 'description': 1.0}
+# A prefix match counts for less than the whole word
+PREFIX_FACTOR = 0.5
+
+_TOKEN = re.compile(r'\w+')
+
+
+def fold(text):
+    """Lowercase ``text`` and strip diacritics (ë -> e, ç -> c)."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return _TOKEN.findall(fold(text or ''))
+
+
+def digest(row):
+    """A fingerprint of the fields of ``row`` that are indexed."""
+    return hash(tuple(row.get(field) for field in FIELD_WEIGHTS))
+
+
+class SearchIndex:
+    """Token -> {product id: weight} postings with a sorted vocabulary for prefix lookups.
+
+    Products are added, replaced and removed one at a time, so a catalog
+    change only touches the postings of the products that changed.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._vocabulary = []
+        # product id -> (digest, {token: weight}, name)
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._pending = None
+        self._syncing = False
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, row):
+        """Index (or re-index) one catalog row."""
+        weights = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(row.get(field)):
+                weights[token] = weights.get(token, 0.0) + weight
+        with self._lock:
+            self._remove(row['id'])
+            self._documents[row['id']] = (digest(row), weights, row['name'])
+            for token, weight in weights.items():
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    bisect.insort(self._vocabulary, token)
+                postings[row['id']] = weight
+
+    def remove(self, product_id):
+        with self._lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id):
+        # Called with the lock held
+        document = self._documents.pop(product_id, None)
+        if document is None:
+            return
+        for token in document[1]:
+            postings = self._postings[token]
+            del postings[product_id]
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def sync(self, rows):
+        """Bring the index in line with a catalog snapshot, touching only what changed."""
+        seen = set()
+        changed = []
+        for row in rows:
+            seen.add(row['id'])
+            document = self._documents.get(row['id'])
+            if document is None or document[0] != digest(row):
+                changed.append(row)
+        with self._lock:
+            removed = [product_id for product_id in self._documents if product_id not in seen]
+        for product_id in removed:
+            self.remove(product_id)
+        for row in changed:
+            self.add(row)
+        return len(removed) + len(changed)
+
+    def sync_later(self, rows):
+        """:meth:`sync` on a background thread; a call made while one runs replaces any still waiting.
+
+        Until it finishes, searches answer from the previous catalog.
+        """
+        with self._lock:
+            self._pending = rows
+            if self._syncing:
+                return
+            self._syncing = True
+        threading.Thread(target=self._sync_pending, name='search-index', daemon=True).start()
+
+    def _sync_pending(self):
+        while True:
+            with self._lock:
+                rows, self._pending = self._pending, None
+                if rows is None:
+                    self._syncing = False
+                    return
+            try:
+                self.sync(rows)
+            except Exception:
+                logger.exception("Could not index the catalog for search")
+
+    def _prefix_tokens(self, prefix):
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        end = bisect.bisect_left(self._vocabulary, prefix + '\uffff')
+        return self._vocabulary[start:end]
+
+    def _matches(self, token, prefix):
+        postings = self._postings.get(token, {})
+        if not prefix:
+            return postings
+        # The last token may still be half typed: also match longer words starting with it
+        matches = dict(postings)
+        for candidate in self._prefix_tokens(token):
+            if candidate == token:
+                continue
+            for product_id, weight in self._postings[candidate].items():
+                matches[product_id] = max(matches.get(product_id, 0.0), weight * PREFIX_FACTOR)
+        return matches
+
+    def search(self, query, limit=None):
+        """Return the ids of the products matching every token of ``query``, best matches first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            matches = [self._matches(token, prefix=position == len(tokens) - 1)
+                       for position, token in enumerate(tokens)]
+            # Intersect starting from the rarest token so the candidate set stays small
+            matches.sort(key=len)
+            scores = dict(matches[0])
+            for postings in matches[1:]:
+                scores = {product_id: score + postings[product_id]
+                          for product_id, score in scores.items() if product_id in postings}
+                if not scores:
+                    return []
+
+            def rank(item):
+                return -item[1], self._documents[item[0]][2]
+
+            if limit is None or limit >= len(scores):
+                ranked = sorted(scores.items(), key=rank)
+            else:
+                ranked = heapq.nsmallest(limit, scores.items(), key=rank)
+            return [product_id for product_id, _ in ranked]
@@ -0,0 +1,347 @@
+"""Catalog snapshots shared by all worker processes through one memory-mapped file.
+
+Under several worker processes every worker used to sync, index and hold
+its own copy of the catalog. With a snapshot path configured, one worker at
+a time (whichever takes the refresh lock) syncs the catalog and publishes it
+as an immutable, versioned file. Every worker maps the newest file read-only
+and swaps to it when a new one lands. The file's pages are shared by all
+processes through the page cache, and a product is only turned into a dict
+when a request reads it.
+
+Layout, in native byte order (the file never leaves the machine), with the
+rows in :func:`catalog.sort_key` order::
+
+    header   MAGIC, length of meta (u32), padding
+    meta     JSON: version, changed_at, stale, published_at, count, where each
+             section starts, and {name: [start, count]} into ``groups`` for
+             every category and farmer
+    fields   per row, a u32 (offset, length) pair into ``strings`` for each
+             of TEXT_FIELDS; length NONE stands for None
+    numbers  per row, i64 unit_amount and created
+    by_id    u32 row numbers sorted by product id, for binary search
+    groups   u32 row numbers of each category, then of each farmer
+    strings  UTF-8 text, each distinct string stored once
+
+Publishing writes a temporary file next to the snapshot and renames it over
+the old one, so a reader maps either the old file or the new one, never a
+mix. A worker still serving from the old file keeps it until it lets go.
+"""
+import array
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections.abc import Mapping, Sequence
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where the app runs as a single process anyway
+    fcntl = None
+
+MAGIC = b'MBCAT001'
+_HEADER = struct.Struct('=8sI4x')
+TEXT_FIELDS = ('id', 'name', 'description', 'image', 'category', 'farmer', 'price_id')
+_SPANS = len(TEXT_FIELDS) * 2
+NONE = 0xFFFFFFFF
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def write_snapshot(path, catalog, published_at=None):
+    """Write ``catalog`` (a :class:`catalog.CatalogIndex`) to ``path`` atomically; returns the file size."""
+    strings = bytearray()
+    spans = {}
+    fields = array.array('I')
+    numbers = array.array('q')
+    ids = []
+    groups = {'categories': {}, 'farmers': {}}
+    for number, row in enumerate(catalog.ordered):
+        for field in TEXT_FIELDS:
+            value = row[field]
+            if value is None:
+                fields.extend((0, NONE))
+                continue
+            span = spans.get(value)
+            if span is None:
+                data = value.encode('utf-8')
+                span = spans[value] = (len(strings), len(data))
+                strings += data
+            fields.extend(span)
+        numbers.extend((round(row['price'] * 100), row['created']))
+        ids.append(row['id'])
+        groups['categories'].setdefault(row['category'], []).append(number)
+        groups['farmers'].setdefault(row['farmer'], []).append(number)
+
+    members = array.array('I')
+    tables = {}
+    for kind, table in groups.items():
+        tables[kind] = {}
+        for name, rows in table.items():
+            tables[kind][name] = [len(members), len(rows)]
+            members.extend(rows)
+    by_id = array.array('I', sorted(range(len(ids)), key=ids.__getitem__))
+
+    sections = {}
+    blobs = []
+    position = 0
+    for name, blob in (('fields', fields), ('numbers', numbers), ('by_id', by_id), ('groups', members),
+                       ('strings', strings)):
+        data = bytes(blob) if isinstance(blob, bytearray) else blob.tobytes()
+        sections[name] = [position, len(data)]
+        blobs.append((position, data))
+        position = _align(position + len(data))
+    meta = json.dumps({
+        'version': catalog.version,
+        'changed_at': catalog.changed_at,
+        'stale': catalog.stale,
+        'published_at': time.time() if published_at is None else published_at,
+        'count': len(ids),
+        'sections': sections,
+        **tables,
+    }, separators=(',', ':')).encode('utf-8')
+
+    base = _align(_HEADER.size + len(meta))
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temporary, 'wb') as out:
+            out.write(_HEADER.pack(MAGIC, len(meta)))
+            out.write(meta)
+            for start, data in blobs:
+                out.seek(base + start)
+                out.write(data)
+            out.truncate(base + position)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        raise
+    return base + position
+
+
+class _Rows(Sequence):
+    """Rows of a snapshot by row number, decoded as they are read."""
+
+    def __init__(self, snapshot, numbers):
+        self._snapshot = snapshot
+        self._numbers = numbers
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._snapshot.row(number) for number in self._numbers[index]]
+        return self._snapshot.row(self._numbers[index])
+
+
+class _RowsById(Mapping):
+    """The ``rows`` dict of :class:`catalog.CatalogIndex`, answered from the snapshot."""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __getitem__(self, product_id):
+        row = self._snapshot.get(product_id)
+        if row is None:
+            raise KeyError(product_id)
+        return row
+
+    def __iter__(self):
+        return (self._snapshot.product_id(number) for number in range(len(self._snapshot)))
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def values(self):
+        return self._snapshot.ordered
+
+
+class SnapshotCatalog:
+    """One published snapshot, mapped read-only, answering like :class:`catalog.CatalogIndex`.
+
+    Its lists are sequences that decode a row when it is read, so a page of
+    24 products decodes 24 rows whatever the size of the catalog.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.size = stat.st_size
+        magic, meta_length = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        meta = json.loads(self._map[_HEADER.size:_HEADER.size + meta_length])
+        base = _align(_HEADER.size + meta_length)
+        view = memoryview(self._map)
+
+        def section(name, format):
+            start, length = meta['sections'][name]
+            return view[base + start:base + start + length].cast(format)
+
+        self._fields = section('fields', 'I')
+        self._numbers = section('numbers', 'q')
+        self._by_id = section('by_id', 'I')
+        self._groups = section('groups', 'I')
+        # Text is sliced straight from the map, which is cheaper than going through a memoryview
+        self._text_base = base + meta['sections']['strings'][0]
+        self._count = meta['count']
+        self._categories = meta['categories']
+        self._farmers = meta['farmers']
+        self.version = meta['version']
+        self.changed_at = meta['changed_at']
+        self.stale = meta['stale']
+        self.published_at = meta['published_at']
+
+    def _text(self, offset, length):
+        if length == NONE:
+            return None
+        start = self._text_base + offset
+        return self._map[start:start + length].decode('utf-8')
+
+    def product_id(self, number):
+        start = number * _SPANS
+        return self._text(self._fields[start], self._fields[start + 1])
+
+    def row(self, number):
+        """Row ``number`` (in sort order) as the dict the templates render."""
+        spans = self._fields[number * _SPANS:(number + 1) * _SPANS].tolist()
+        text = self._text
+        return {
+            'id': text(spans[0], spans[1]),
+            'name': text(spans[2], spans[3]),
+            'description': text(spans[4], spans[5]),
+            'image': text(spans[6], spans[7]),
+            'price': self._numbers[number * 2] / 100,
+            'category': text(spans[8], spans[9]),
+            'farmer': text(spans[10], spans[11]),
+            'price_id': text(spans[12], spans[13]),
+            'created': self._numbers[number * 2 + 1],
+        }
+
+    @property
+    def ordered(self):
+        return _Rows(self, range(self._count))
+
+    @property
+    def rows(self):
+        return _RowsById(self)
+
+    def __len__(self):
+        return self._count
+
+    def get(self, product_id):
+        position = bisect.bisect_left(self._by_id, product_id, key=self.product_id)
+        if position < len(self._by_id) and self.product_id(self._by_id[position]) == product_id:
+            return self.row(self._by_id[position])
+        return None
+
+    def _group(self, table, name):
+        start, count = table.get(name, (0, 0))
+        return _Rows(self, self._groups[start:start + count])
+
+    def category(self, category):
+        return self._group(self._categories, category)
+
+    def farmer(self, name):
+        return self._group(self._farmers, name)
+
+
+class SnapshotStore:
+    """Publishes catalog snapshots to ``path`` and keeps the newest one mapped.
+
+    :meth:`current` looks for a newer file at most every ``check_interval``
+    seconds. ``on_swap`` is called with each snapshot as it is mapped (to
+    update the search index, say); meanwhile other threads keep getting the
+    previous one.
+    """
+
+    def __init__(self, path, check_interval=1.0, on_swap=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.on_swap = on_swap
+        self.published = 0
+        self.swaps = 0
+        self._current = None
+        self._checked = float('-inf')
+        self._lock = threading.Lock()
+
+    def current(self):
+        """The newest published snapshot, or None before the first one."""
+        if time.monotonic() - self._checked < self.check_interval:
+            return self._current
+        with self._lock:
+            if time.monotonic() - self._checked < self.check_interval:
+                return self._current
+            self._checked = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self._current
+            current = self._current
+            if current is not None and current.identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                return current
+            try:
+                snapshot = SnapshotCatalog(self.path)
+            except (OSError, ValueError):
+                # Left by an older version of the app, say; the next refresh replaces it
+                return current
+            if self.on_swap is not None:
+                self.on_swap(snapshot)
+            self._current = snapshot
+            self.swaps += 1
+            return snapshot
+
+    def age(self):
+        """Seconds since the newest snapshot was published (infinite before the first)."""
+        snapshot = self.current()
+        return float('inf') if snapshot is None else time.time() - snapshot.published_at
+
+    def publish(self, catalog):
+        """Write ``catalog`` as the new snapshot and start serving it in this process."""
+        write_snapshot(self.path, catalog)
+        self.published += 1
+        self._checked = float('-inf')
+        return self.current()
+
+    @contextlib.contextmanager
+    def refreshing(self, wait=False):
+        """Take the refresh lock unless another process holds it; yields whether this one got it.
+
+        With ``wait`` it waits for the other process to let go instead, and always gets it.
+        """
+        if fcntl is None:
+            yield True
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def stats(self):
+        snapshot = self._current
+        return {
+            'path': self.path,
+            'version': snapshot.version if snapshot else None,
+            'products': len(snapshot) if snapshot else 0,
+            'bytes': snapshot.size if snapshot else 0,
+            'age': round(self.age(), 1) if snapshot else None,
+            'published': self.published,
+            'swaps': self.swaps,
+        }
@@ -136,4 +136,120 @@ document.querySelectorAll('a[href^="#"]').forEach(anchor => {
             });
         }
     });
-}); 
\ No newline at end of file
+}); 
+
+// Lazy loading: fetch the next page of products from /api/products when the user nears the end of the list
+function productElement(tag, className, text) {
+    const element = document.createElement(tag);
+    if (className) element.className = className;
+    if (text !== undefined) element.textContent = text;
+    return element;
+}
+
+function hiddenInput(name, value) {
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = name;
+    input.value = value;
+    return input;
+}
+
+function productCard(product) {
+    const column = productElement('div', 'col-md-4');
+    const card = productElement('div', 'card');
+    const image = productElement('img', 'card-img-top');
+    image.src = product.image;
+    image.alt = product.name;
+    image.loading = 'lazy';
+    const body = productElement('div', 'card-body');
+    body.append(productElement('h5', 'card-title', product.name),
+                productElement('p', 'card-text', product.description));
+    const price = productElement('p', 'card-text');
+    price.append(productElement('strong', '', 'Çmimi: '), `L${product.price} ALL`);
+    const category = productElement('p', 'card-text');
+    category.append(productElement('strong', '', 'Kategoria: '), product.category);
+    body.append(price, category);
+    card.append(image, body);
+    column.append(card);
+    return [column];
+}
+
+function productFeaturette(product, canBuy) {
+    const row = productElement('div', 'row featurette');
+    const left = productElement('div', 'col-md-6');
+    const form = productElement('form');
+    form.action = '/add-to-cart';
+    form.method = 'post';
+    form.append(hiddenInput('product_id', product.id),
+                productElement('h2', 'featurette-heading fw-normal lh-1', product.name),
+                productElement('p', 'lead', product.description),
+                productElement('p', 'lead fw-semibold', `Price: L${product.price} ALL`));
+    if (canBuy) {
+        const box = productElement('div', 'left product-quantity-box d-flex align-items-center gap-3 py-3');
+        box.append(productElement('label', 'form-label mb-0 me-2 lead fw-semibold', 'Qunatity:'));
+        const group = productElement('div', 'input-group');
+        group.style.maxWidth = '150px';
+        const quantity = productElement('input', 'form-control text-center quantity');
+        quantity.type = 'number';
+        quantity.min = '1';
+        quantity.name = 'quantity';
+        quantity.value = '1';
+        group.append(quantity);
+        box.append(group);
+        form.append(box, productElement('button', 'btn btn-primary rounded-pill px-3', '+ Add to Cart'));
+    }
+    left.append(form);
+    const right = productElement('div', 'col-md-6');
+    const image = productElement('img');
+    image.src = product.image;
+    image.width = 550;
+    image.height = 500;
+    image.style.objectFit = 'cover';
+    image.loading = 'lazy';
+    right.append(image);
+    row.append(left, right);
+    return [row, productElement('hr', 'featurette-divider')];
+}
+
+const LAZY_FIELDS = {
+    card: 'id,name,description,image,price,category',
+    featurette: 'id,name,description,image,price',
+};
+
+document.querySelectorAll('.lazy-products').forEach(sentinel => {
+    const layout = sentinel.dataset.layout;
+    const canBuy = sentinel.dataset.canBuy === 'true';
+    let cursor = sentinel.dataset.cursor;
+    let loading = false;
+
+    const observer = new IntersectionObserver(async entries => {
+        if (!entries.some(entry => entry.isIntersecting) || loading || !cursor) return;
+        loading = true;
+        try {
+            const url = new URL(sentinel.dataset.api, window.location.origin);
+            url.searchParams.set('cursor', cursor);
+            url.searchParams.set('fields', LAZY_FIELDS[layout]);
+            const response = await fetch(url);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const page = await response.json();
+            page.data.forEach(product => {
+                const elements = layout === 'card' ? productCard(product) : productFeaturette(product, canBuy);
+                elements.forEach(element => sentinel.before(element));
+            });
+            cursor = page.next_cursor;
+        } catch (error) {
+            console.error('Could not load more products', error);
+        } finally {
+            loading = false;
+        }
+        if (!cursor) {
+            observer.disconnect();
+            sentinel.remove();
+        } else {
+            // Observe again so a sentinel that is still on screen triggers the next page
+            observer.unobserve(sentinel);
+            observer.observe(sentinel);
+        }
+    }, { rootMargin: '600px 0px' });
+    observer.observe(sentinel);
+});
@@ -0,0 +1,118 @@
+"""Streamed HTML responses for long product listings.
+
+``render_template`` returns a page only once all of it has been rendered, so
+the browser receives nothing until the whole catalog has been loaded and
+every row turned into HTML. ``stream_page`` sends the page in chunks
+instead. Everything up to the template's ``{{ flush }}`` marker (header and
+navigation) goes out at once. The rows then follow in chunks of about
+``chunk_size`` bytes as the template loop produces them, so a response never
+holds more than one chunk of HTML in memory.
+
+Templates rendered with plain ``render_template`` leave ``flush`` undefined,
+and it renders as an empty string there.
+
+Pages that look the same for every visitor with a given role can be kept in
+a ``PageCache``. Each cached page is tagged with the catalog version it was
+rendered from, and a newer version makes it stale.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from flask import Response, before_render_template, stream_with_context, template_rendered
+from markupsafe import Markup, escape
+
+logger = logging.getLogger(__name__)
+
+FLUSH = Markup('<!-- flush -->')
+
+
+def chunked(events, chunk_size):
+    """Join template events into chunks of at least ``chunk_size`` characters, flushing early at FLUSH."""
+    pending = []
+    size = 0
+    for event in events:
+        if event == FLUSH:
+            if pending:
+                yield ''.join(pending)
+                pending = []
+                size = 0
+            continue
+        pending.append(event)
+        size += len(event)
+        if size >= chunk_size:
+            yield ''.join(pending)
+            pending = []
+            size = 0
+    if pending:
+        yield ''.join(pending)
+
+
+def stream_page(app, template_name, chunk_size=8192, on_complete=None, **context):
+    """Render ``template_name`` as a streamed response (see the module docstring).
+
+    ``on_complete`` is called with the whole page once it has been sent in
+    full, e.g. to put it in a :class:`PageCache`.
+    """
+    context['flush'] = FLUSH
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    # The same signals as Flask's own stream_template, so listeners (metrics.py) see streamed pages too
+    before_render_template.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+
+    def generate():
+        parts = [] if on_complete is not None else None
+        try:
+            for chunk in chunked(template.generate(context), chunk_size):
+                if parts is not None:
+                    parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            # The status line has already been sent, so report the error in the page itself
+            logger.exception("Streaming %s failed", template_name)
+            yield str(escape(f"Error: {e}"))
+            return
+        template_rendered.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+        if parts is not None:
+            on_complete(''.join(parts))
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+class PageCache:
+    """LRU of rendered pages, each stored with the catalog version it was rendered from."""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return the page cached under ``key`` if it was rendered at ``version``, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, page):
+        if not self.max_entries:
+            return
+        with self._lock:
+            current = self._entries.get(key)
+            # A slower render of an older snapshot must not replace a newer page
+            if current is not None and current[0] > version:
+                return
+            self._entries[key] = (version, page)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,99 @@
+"""Shared thread pool for Stripe API calls.
+
+Independent Stripe requests (catalog pages, bulk product updates, ...) are
+submitted to one bounded ``StripeExecutor`` so they run side by side instead
+of one after another. The pool size caps how many requests are in flight at
+once, and a token bucket keeps the request rate under Stripe's limit.
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` acquisitions per second with bursts up to ``burst``."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class StripeExecutor:
+    """A bounded, rate-limited pool for Stripe I/O, optionally behind a breaker.CircuitBreaker."""
+
+    def __init__(self, max_workers=8, rate=25, breaker=None):
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate)
+        self.breaker = breaker
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stripe')
+
+    def call(self, fn, *args, **kwargs):
+        """Run one Stripe request on the calling thread, respecting the rate limit and the breaker."""
+        self.limiter.acquire()
+        if self.breaker is None:
+            return fn(*args, **kwargs)
+        return self.breaker.call(fn, *args, **kwargs)
+
+    def call_within(self, timeout, fn, *args, **kwargs):
+        """:meth:`call` on a thread of its own, waiting at most ``timeout`` seconds; raises TimeoutError after that.
+
+        The pool is not used, as long listings may keep all of its workers
+        busy. A call given up on still finishes in the background, each
+        attempt bounded by the HTTP client's timeout.
+        """
+        future = Future()
+        context = contextvars.copy_context()
+
+        def run():
+            try:
+                future.set_result(context.run(self.call, fn, *args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name='stripe-call', daemon=True).start()
+        return future.result(timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run one Stripe request on the pool; returns a Future.
+
+        It runs in a copy of the caller's context, so context variables (the
+        request's timings, say) follow it onto the pool thread.
+        """
+        return self._pool.submit(contextvars.copy_context().run, self.call, fn, *args, **kwargs)
+
+    def map(self, fn, iterable):
+        """Call ``fn`` on every item concurrently and return the results in order.
+
+        Waits for every call to finish, then re-raises the first error, if any.
+        """
+        futures = [self.submit(fn, item) for item in iterable]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return [future.result() for future in futures]
+
+    def spawn(self, fn, *args, **kwargs):
+        """Run a long-lived task (such as a pagination producer) on the pool.
+
+        The task is not rate limited itself; it should use :meth:`call` for
+        each request it makes. Like :meth:`submit`, it runs in a copy of the
+        caller's context.
+        """
+        return self._pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)